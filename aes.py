@@ -1,31 +1,100 @@
 import sys
 import getopt
 import math
+import mmap
+import os
+import struct
+import hashlib
+import hmac
+import threading
+import time
+from array import array
 from enum import Enum
-from collections import deque
+from collections import deque, OrderedDict
 from constants import *
+import ttable
+import vectorized
+import bitsliced
+import modes
+import gcm
+import container
+import pipeline
+import batch
+import stats as statistics
 
 Mode = Enum('Mode', 'ENCRYPT DECRYPT')
 KeySize = Enum('KeySize', 'B128 B256')
+Engine = Enum('Engine', 'REFERENCE TTABLE NUMPY BITSLICE')
+CipherMode = Enum('CipherMode', 'ECB CTR CBC GCM')
 
+# Cipher mode codes stored in a container header
+CONTAINER_MODES = {CipherMode.CTR: container.MODE_CTR,
+                   CipherMode.CBC: container.MODE_CBC}
 
-def main(argv):
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Maximum number of expanded keys kept by the AES key cache
+KEY_CACHE_SIZE = 64
+
+USAGE = ("Usage: aes.py --keysize $KEYSIZE --keyfile $KEYFILE "
+         "--inputfile $INPUTFILE --outputfile $OUTFILENAME --mode "
+         "$MODE [--engine reference|ttable|numpy|bitslice] "
+         "[--chunksize $BYTES] [--mmap | --inplace] "
+         "[--ciphermode ecb|ctr|cbc|gcm] [--nonce $HEX] [--workers $N] "
+         "[--stats] [--stats-json $PATH] [--stats-rounds] "
+         "[--container] [--range START:END] [--queuedepth $N]\n"
+         "       aes.py --keysize $KEYSIZE --keyfile $KEYFILE "
+         "(--inputdir $DIR|$GLOB | --manifest $FILE) --outputdir $DIR "
+         "--mode $MODE [options]")
+
+# Key schedule and options held by each batch worker process, set once by
+# initBatchWorker()
+batchOptions = None
+
+# Functions timed individually by --stats-rounds
+ROUND_FUNCTIONS = ("subBytes", "shiftRows", "mixColumns", "addRoundKey",
+                   "generateRoundKeys")
+
+
+def main(argv, statsHook=None):
+    """Runs the command line tool. If statsHook is given, statistics are
+       collected as with --stats and the report is passed to statsHook."""
     # Handle args
-    if len(argv) < 10:
-        print(("Usage: aes.py --keysize $KEYSIZE --keyfile $KEYFILE "
-               "--inputfile $INPUTFILE --outputfile $OUTFILENAME --mode "
-               "$MODE"))
+    if len(argv) < 9:
+        print(USAGE)
         sys.exit()
 
     opts, args = getopt.getopt(argv, "", ["keysize=", "keyfile=",
-                               "inputfile=", "outputfile=", "mode="])
+                               "inputfile=", "outputfile=", "mode=",
+                               "engine=", "chunksize=", "mmap",
+                               "inplace", "ciphermode=", "nonce=",
+                               "workers=", "stats", "stats-json=",
+                               "stats-rounds", "inputdir=", "manifest=",
+                               "outputdir=", "container", "range=",
+                               "queuedepth="])
 
     # Variables to hold arg values
     keySize = None
     keyFile = None
-    inputFile = None
-    outputFile = None
+    inputPath = None
+    outputPath = None
     mode = None
+    engine = Engine.BITSLICE
+    chunkSize = DEFAULT_CHUNK_SIZE
+    useMmap = False
+    inplace = False
+    cipherMode = CipherMode.ECB
+    nonce = None
+    workers = None
+    printStats = False
+    statsPath = None
+    statsRounds = False
+    inputDir = None
+    manifest = None
+    outputDir = None
+    useContainer = False
+    byteRange = None
+    queueDepth = pipeline.DEFAULT_DEPTH
 
     # Set variables based on arg values
     for opt, arg in opts:
@@ -37,62 +106,225 @@ def main(argv):
         elif opt == "--keyfile":
             keyFile = open(arg, "rb")
         elif opt == "--inputfile":
-            inputFile = open(arg, "rb")
+            inputPath = arg
         elif opt == "--outputfile":
-            outputFile = open(arg, "wb")
+            outputPath = arg
         elif opt == "--mode":
             if arg in ("encrypt", "e", "0"):
                 mode = Mode.ENCRYPT
             elif arg in ("decrypt", "d", "1"):
                 mode = Mode.DECRYPT
+        elif opt == "--engine":
+            if arg in ("reference", "ref"):
+                engine = Engine.REFERENCE
+            elif arg in ("ttable", "table"):
+                engine = Engine.TTABLE
+            elif arg in ("numpy", "np"):
+                engine = Engine.NUMPY
+            elif arg in ("bitslice", "bs"):
+                engine = Engine.BITSLICE
+        elif opt == "--chunksize":
+            chunkSize = int(arg)
+        elif opt == "--mmap":
+            useMmap = True
+        elif opt == "--inplace":
+            inplace = True
+        elif opt == "--ciphermode":
+            if arg in ("ecb", "ECB"):
+                cipherMode = CipherMode.ECB
+            elif arg in ("ctr", "CTR"):
+                cipherMode = CipherMode.CTR
+            elif arg in ("cbc", "CBC"):
+                cipherMode = CipherMode.CBC
+            elif arg in ("gcm", "GCM"):
+                cipherMode = CipherMode.GCM
+        elif opt == "--nonce":
+            nonce = bytes.fromhex(arg)
+        elif opt == "--workers":
+            workers = int(arg)
+        elif opt == "--stats":
+            printStats = True
+        elif opt == "--stats-json":
+            statsPath = arg
+        elif opt == "--stats-rounds":
+            statsRounds = True
+        elif opt == "--inputdir":
+            inputDir = arg
+        elif opt == "--manifest":
+            manifest = arg
+        elif opt == "--outputdir":
+            outputDir = arg
+        elif opt == "--container":
+            useContainer = True
+        elif opt == "--range":
+            byteRange = container.parseRange(arg)
+            useContainer = True
+        elif opt == "--queuedepth":
+            queueDepth = int(arg)
 
-    numRounds = 10 if keySize is KeySize.B128 else 14
+    batchMode = inputDir is not None or manifest is not None
+    if chunkSize <= 0:
+        sys.exit("--chunksize must be a positive number of bytes")
+    if queueDepth <= 0:
+        sys.exit("--queuedepth must be a positive number of chunks")
+    if workers is not None and workers < 1:
+        sys.exit("--workers must be at least 1")
+    if nonce is not None and len(nonce) != modes.NONCE_SIZE:
+        sys.exit("--nonce must be %d bytes (%d hex digits)" %
+                 (modes.NONCE_SIZE, 2 * modes.NONCE_SIZE))
+    if batchMode and outputDir is None:
+        sys.exit(USAGE)
+    if batchMode and nonce is not None and cipherMode is CipherMode.CTR \
+            and mode is Mode.ENCRYPT:
+        sys.exit("--nonce cannot be used to encrypt a batch of files")
+    if useContainer:
+        if byteRange is not None and (mode is Mode.ENCRYPT or batchMode):
+            sys.exit("--range only applies when decrypting a single file")
+        if cipherMode is CipherMode.ECB:
+            cipherMode = CipherMode.CTR
+        elif cipherMode not in CONTAINER_MODES:
+            sys.exit("--container only supports ctr and cbc")
+    if outputPath is None and not inplace and not batchMode:
+        sys.exit(USAGE)
+    if (useMmap or inplace) and (cipherMode is not CipherMode.ECB or
+                                 useContainer):
+        sys.exit("--mmap and --inplace only support ecb")
+    if (useMmap or inplace) and "-" in (inputPath, outputPath):
+        sys.exit("--mmap and --inplace need files, not stdin or stdout")
+    if statsPath == "-" and outputPath == "-":
+        sys.exit("--stats-json - cannot share stdout with --outputfile -")
+
+    # Statistics are only collected when asked for, so by default the run
+    # has no instrumentation overhead
+    stats = None
+    if printStats or statsPath or statsRounds or statsHook:
+        stats = statistics.Stats()
+        if statsRounds:
+            stats.instrument(globals(), ROUND_FUNCTIONS)
+            stats.instrument(vars(ttable), ("encryptBlocks",
+                                            "decryptBlocks"))
+            stats.instrument(vars(bitsliced), ("encryptSlices",
+                                               "decryptSlices"))
+
+    outputFile = None
+    try:
+        numRounds = 10 if keySize is KeySize.B128 else 14
+
+        # Generate round keys/key schedule based on the input key
+        with statistics.timedStage(stats, "keyExpansion"):
+            keyBytes = inputKeyBytes(keyFile, keySize)
+            roundKeys = generateRoundKeys(keyBytes, keySize)
+            keySchedule = [w for rk in roundKeys
+                           for w in rk][:(numRounds+1)*4]
+
+        if batchMode:
+            failures = cipherBatch(inputDir, manifest, outputDir, keySchedule,
+                                   numRounds, mode, engine, cipherMode,
+                                   chunkSize, nonce, useContainer, workers,
+                                   stats)
+            if failures:
+                sys.exit(1)
+            return
+
+        if useMmap or inplace:
+            cipher = blockCipher(keySchedule, numRounds, mode, engine)
+            with statistics.timedStage(stats, "cipher"):
+                mmapCipher(inputPath, None if inplace else outputPath,
+                           cipher, mode, chunkSize)
+            if stats is not None:
+                stats.record("cipher", 0, os.path.getsize(inputPath))
+            return
 
-    # Generate round keys/key schedule based on the input key
-    keyBytes = inputKeyBytes(keyFile, keySize)
-    roundKeys = generateRoundKeys(keyBytes, keySize)
-    keySchedule = [w for rk in roundKeys for w in rk][:(numRounds+1)*4]
+        inputFile = statistics.timedFile(stats, openFile(inputPath, "rb"))
+        outputFile = statistics.timedFile(stats, openFile(outputPath, "wb"))
 
-    # Parse input file into the input state & initialize empty output state
-    inputState = inputToState(inputFile, mode)
-    outputState = []
+        # A range is read out of place, and GCM decryption reads the input
+        # twice so that nothing is written before the tag is checked
+        if (byteRange is not None or (cipherMode is CipherMode.GCM and
+                                      mode is Mode.DECRYPT)) \
+                and not inputFile.seekable():
+            sys.exit("--range and GCM decryption need a seekable input")
 
-    if mode is Mode.ENCRYPT:
-        # AES Encryption Cipher Algorithm
-        for block in inputState:
-            newBlock = addRoundKey(block, keySchedule, 0)
+        if byteRange is not None:
+            # Only the blocks covering the range are read and decrypted
+            rk = ttable.wordSchedule(keySchedule)
+            with statistics.timedStage(stats, "cipher"):
+                data = container.decryptRange(inputFile, rk, numRounds,
+                                              *byteRange)
+            outputFile.write(data)
+            return
 
-            for r in range(1, numRounds):
-                newBlock = subBytes(newBlock, mode)
-                newBlock = shiftRows(newBlock, mode)
-                newBlock = mixColumns(newBlock, mode)
-                newBlock = addRoundKey(newBlock, keySchedule, r)
+        if cipherMode is not CipherMode.ECB or engine is not Engine.REFERENCE:
+            cipherStream(inputFile, outputFile, keySchedule, numRounds, mode,
+                         engine, cipherMode, chunkSize, nonce, useContainer,
+                         workers, stats, queueDepth)
+            return
 
-            newBlock = subBytes(newBlock, mode)
-            newBlock = shiftRows(newBlock, mode)
-            newBlock = addRoundKey(newBlock, keySchedule, numRounds)
+        # Parse input file into the input state & initialize empty output
+        # state
+        inputState = inputToState(inputFile, mode)
+        outputState = []
+        with statistics.timedStage(stats, "cipher"):
+            if mode is Mode.ENCRYPT:
+                # AES Encryption Cipher Algorithm
+                for block in inputState:
+                    newBlock = addRoundKey(block, keySchedule, 0)
 
-            outputState.append(newBlock)
+                    for r in range(1, numRounds):
+                        newBlock = subBytes(newBlock, mode)
+                        newBlock = shiftRows(newBlock, mode)
+                        newBlock = mixColumns(newBlock, mode)
+                        newBlock = addRoundKey(newBlock, keySchedule, r)
 
-    elif mode is Mode.DECRYPT:
-        # AES Decryption Cipher Algorithm
-        for block in inputState:
-            newBlock = addRoundKey(block, keySchedule, numRounds)
+                    newBlock = subBytes(newBlock, mode)
+                    newBlock = shiftRows(newBlock, mode)
+                    newBlock = addRoundKey(newBlock, keySchedule, numRounds)
 
-            for r in reversed(range(1, numRounds)):
-                newBlock = shiftRows(newBlock, mode)
-                newBlock = subBytes(newBlock, mode)
-                newBlock = addRoundKey(newBlock, keySchedule, r)
-                newBlock = mixColumns(newBlock, mode)
+                    outputState.append(newBlock)
 
-            newBlock = shiftRows(newBlock, mode)
-            newBlock = subBytes(newBlock, mode)
-            newBlock = addRoundKey(newBlock, keySchedule, 0)
+            elif mode is Mode.DECRYPT:
+                # AES Decryption Cipher Algorithm
+                for block in inputState:
+                    newBlock = addRoundKey(block, keySchedule, numRounds)
 
-            outputState.append(newBlock)
+                    for r in reversed(range(1, numRounds)):
+                        newBlock = shiftRows(newBlock, mode)
+                        newBlock = subBytes(newBlock, mode)
+                        newBlock = addRoundKey(newBlock, keySchedule, r)
+                        newBlock = mixColumns(newBlock, mode)
 
-    # Write output state to output file
-    stateToOutput(outputState, outputFile, mode)
+                    newBlock = shiftRows(newBlock, mode)
+                    newBlock = subBytes(newBlock, mode)
+                    newBlock = addRoundKey(newBlock, keySchedule, 0)
+
+                    outputState.append(newBlock)
+
+        if stats is not None:
+            stats.record("cipher", 0, len(outputState) * 16)
+
+        # Write output state to output file
+        stateToOutput(outputState, outputFile, mode)
+    finally:
+        if outputFile is not None:
+            outputFile.close()
+        if stats is not None:
+            stats.finish()
+            reportStats(stats, printStats, statsPath, statsHook)
+
+
+def reportStats(stats, printStats, statsPath, statsHook):
+    """Prints and saves the statistics collected during a run, and passes
+       them to the hook if one was given. A statsPath of "-" writes the JSON
+       to stdout."""
+    if printStats:
+        print(stats.summary(), file=sys.stderr)
+    if statsPath == "-":
+        print(stats.toJson())
+    elif statsPath:
+        with open(statsPath, "w") as f:
+            f.write(stats.toJson())
+    if statsHook is not None:
+        statsHook(stats.report())
 
 
 def inputToState(input, mode):
@@ -132,6 +364,345 @@ def inputToState(input, mode):
     return state
 
 
+def padLength(length):
+    """Returns the number of CMS padding bytes added to an input of the given
+       length; inputs that are already a multiple of 16 are not padded."""
+    return -length % 16
+
+
+def unpadLength(data):
+    """Returns the number of padding bytes to strip from the end of the
+       decrypted data, which holds the final block and optionally the byte
+       before it. The last byte is taken as padding only if exactly that
+       many trailing bytes share its value. Padding never spans more than
+       the final block."""
+    if not data:
+        return 0
+    paddedBytes = data[-1]
+    if paddedBytes == 0 or paddedBytes > min(16, len(data)):
+        return 0
+    if data[-paddedBytes:] != bytes([paddedBytes]) * paddedBytes:
+        return 0
+    if len(data) > paddedBytes and data[-paddedBytes - 1] == paddedBytes:
+        return 0
+    return paddedBytes
+
+
+def openFile(path, mode):
+    """Opens a file, or stdin or stdout if path is "-". The standard streams
+       are opened on their file descriptors, so that they are read and
+       written as bytes and closing them leaves the descriptors open."""
+    if path != "-":
+        return open(path, mode)
+    if "r" in mode:
+        return open(sys.stdin.fileno(), mode, closefd=False)
+    sys.stdout.flush()
+    return open(sys.stdout.fileno(), mode, closefd=False)
+
+
+def readChunks(inputFile, chunkSize=DEFAULT_CHUNK_SIZE):
+    """Yields the contents of the input file in chunks of chunkSize bytes"""
+    chunk = inputFile.read(chunkSize)
+    while chunk:
+        yield chunk
+        chunk = inputFile.read(chunkSize)
+
+
+def cipherChunks(chunks, cipher, mode):
+    """Encrypts or decrypts a stream of input chunks, yielding output chunks
+       as soon as they are ready. Partial blocks are carried over to the next
+       chunk. When encrypting, padding is added to the final chunk only; when
+       decrypting, the final block is held back until the end of the input
+       so that its padding can be stripped."""
+    pending = b""
+    lastByte = b""
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        end = len(chunk) - len(chunk) % 16
+        if mode is Mode.DECRYPT and end == len(chunk):
+            end -= 16
+        pending = chunk[end:]
+        if end > 0:
+            out = cipher(chunk[:end] if end < len(chunk) else chunk)
+            lastByte = out[-1:]
+            yield out
+
+    if mode is Mode.ENCRYPT and not pending:
+        return
+    pending += bytes([padLength(len(pending))]) * padLength(len(pending))
+    out = cipher(pending)
+    if mode is Mode.DECRYPT:
+        out = out[:len(out) - unpadLength(lastByte + out)]
+    if out:
+        yield out
+
+
+def mmapCipher(inputPath, outputPath, cipher, mode,
+               chunkSize=DEFAULT_CHUNK_SIZE):
+    """Encrypts or decrypts a file through memory maps. Each chunk of the
+       input mapping is ciphered straight into the output mapping, which is
+       preallocated at the padded size. If outputPath is None the file is
+       converted in place."""
+    inplace = outputPath is None
+    step = max(16, chunkSize - chunkSize % 16)
+    with open(inputPath, "r+b" if inplace else "rb") as inputFile:
+        length = os.fstat(inputFile.fileno()).st_size
+        padding = padLength(length)
+        size = length + padding
+
+        if inplace:
+            outputFile = inputFile
+            # Pad the file itself so that it holds only whole blocks
+            inputFile.seek(length)
+            inputFile.write(bytes([padding]) * padding)
+            inputFile.flush()
+            whole = size
+        else:
+            outputFile = open(outputPath, "w+b")
+            outputFile.truncate(size)
+            whole = length - length % 16
+
+        try:
+            strip = 0
+            if size > 0:
+                outMap = mmap.mmap(outputFile.fileno(), size)
+                inMap = outMap
+                if not inplace and length > 0:
+                    inMap = mmap.mmap(inputFile.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+                with memoryview(inMap) as src, memoryview(outMap) as dst:
+                    for off in range(0, whole, step):
+                        end = min(off + step, whole)
+                        cipher(src[off:end], dst, off)
+                    if whole < size:
+                        tail = bytes(src[whole:length])
+                        tail += bytes([padding]) * padding
+                        cipher(tail, dst, whole)
+                    if mode is Mode.DECRYPT:
+                        strip = unpadLength(bytes(dst[max(0, size-17):]))
+                if inMap is not outMap:
+                    inMap.close()
+                outMap.close()
+            outputFile.truncate(size - strip)
+        finally:
+            if not inplace:
+                outputFile.close()
+
+
+def cipherStream(inputFile, outputFile, keySchedule, numRounds, mode,
+                 engine=Engine.BITSLICE, cipherMode=CipherMode.ECB,
+                 chunkSize=DEFAULT_CHUNK_SIZE, nonce=None,
+                 useContainer=False, workers=None, stats=None,
+                 depth=pipeline.DEFAULT_DEPTH):
+    """Encrypts or decrypts the input file into the output file a chunk at a
+       time in the given cipher mode. ECB mode needs one of the streaming
+       engines, not Engine.REFERENCE. If useContainer is True the output
+       (when encrypting) or input (when decrypting) is a seekable container
+       in CTR or CBC mode; when decrypting, the mode comes from its header.
+       Reading and writing run on their own threads, each connected to the
+       cipher by a queue of up to depth chunks."""
+    def inputChunks():
+        return pipeline.prefetch(readChunks(inputFile, chunkSize), depth,
+                                 stats)
+
+    if useContainer:
+        rk = ttable.wordSchedule(keySchedule)
+        if mode is Mode.ENCRYPT:
+            header = container.newHeader(CONTAINER_MODES[cipherMode],
+                                         chunkSize)
+            outputFile.write(header)
+            chunks = container.encryptChunks(inputChunks(), rk, numRounds,
+                                             header, workers)
+        else:
+            header = inputFile.read(container.HEADER.size)
+            chunks = container.decryptChunks(inputChunks(), rk, numRounds,
+                                             header, workers)
+
+    elif cipherMode is CipherMode.CTR:
+        # Without --nonce, a random nonce is stored as the file header
+        if nonce is None:
+            if mode is Mode.ENCRYPT:
+                nonce = modes.newNonce()
+                outputFile.write(nonce)
+            else:
+                nonce = inputFile.read(modes.NONCE_SIZE)
+                if len(nonce) != modes.NONCE_SIZE:
+                    raise ValueError("input is too short to hold a nonce")
+        rk = ttable.wordSchedule(keySchedule)
+        chunks = modes.ctrChunks(inputChunks(), rk, numRounds, nonce,
+                                 workers)
+
+    elif cipherMode is CipherMode.CBC:
+        # The IV is stored as the first block of the ciphertext
+        rk = ttable.wordSchedule(keySchedule)
+        if mode is Mode.ENCRYPT:
+            iv = modes.newIV()
+            outputFile.write(iv)
+            chunks = modes.cbcEncryptChunks(inputChunks(), rk, numRounds, iv)
+        else:
+            iv = inputFile.read(modes.IV_SIZE)
+            drk = ttable.inverseWordSchedule(rk, numRounds)
+            chunks = modes.cbcDecryptChunks(inputChunks(), drk, numRounds, iv,
+                                            workers)
+
+    elif cipherMode is CipherMode.GCM:
+        # The IV comes first and the tag last
+        rk = ttable.wordSchedule(keySchedule)
+        if mode is Mode.ENCRYPT:
+            iv = gcm.newIV()
+            outputFile.write(iv)
+            chunks = gcm.encryptChunks(inputChunks(), rk, numRounds, iv)
+        else:
+            # Check the tag over the whole input before any plaintext is
+            # written, then go back and decrypt. The second pass checks the
+            # tag again, in case the input changed in between, and the
+            # output is emptied if that check fails.
+            iv = inputFile.read(gcm.IV_SIZE)
+            start = inputFile.tell()
+            with statistics.timedStage(stats, "verify"):
+                gcm.verifyChunks(inputChunks(), rk, numRounds, iv)
+            inputFile.seek(start)
+            chunks = gcm.decryptChunksUnverified(inputChunks(), rk,
+                                                 numRounds, iv)
+            chunks = statistics.timedChunks(stats, "cipher", chunks)
+            outputStart = outputFile.tell() if outputFile.seekable() else None
+            try:
+                pipeline.writeAll(outputFile, chunks, depth, stats)
+            except ValueError:
+                if outputStart is not None:
+                    outputFile.truncate(outputStart)
+                raise
+            return
+
+    else:
+        cipher = blockCipher(keySchedule, numRounds, mode, engine)
+        chunks = cipherChunks(inputChunks(), cipher, mode)
+
+    chunks = statistics.timedChunks(stats, "cipher", chunks)
+    pipeline.writeAll(outputFile, chunks, depth, stats)
+
+
+def cipherBatch(inputDir, manifest, outputDir, keySchedule, numRounds, mode,
+                engine=Engine.BITSLICE, cipherMode=CipherMode.ECB,
+                chunkSize=DEFAULT_CHUNK_SIZE, nonce=None,
+                useContainer=False, workers=None, stats=None):
+    """Encrypts or decrypts every file found by batch.findInputs() into the
+       output directory, spreading the files over a pool of worker
+       processes that share the expanded key. Failed files are reported and
+       skipped. Prints the total throughput and returns the number of files
+       that failed."""
+    if nonce is not None and cipherMode is CipherMode.CTR and \
+            mode is Mode.ENCRYPT:
+        raise ValueError("--nonce would reuse one nonce for every file")
+
+    root, inputs = batch.findInputs(inputDir, manifest, outputDir)
+    jobs = ((p, batch.outputPathFor(p, root, outputDir)) for p in inputs)
+    options = (keySchedule, numRounds, mode, engine, cipherMode, chunkSize,
+               nonce, useContainer)
+
+    start = time.perf_counter()
+    numFiles = failures = totalBytes = 0
+    for inputPath, numBytes, seconds, error in batch.runBatch(
+            jobs, batchTask, initBatchWorker, (options,), workers):
+        if error is not None:
+            failures += 1
+            print("FAILED %s: %s" % (inputPath, error), file=sys.stderr)
+            continue
+        numFiles += 1
+        totalBytes += numBytes
+        if stats is not None:
+            stats.record("file", seconds, numBytes, 1)
+    elapsed = time.perf_counter() - start
+
+    print("%d files, %d failed, %d bytes in %.3f s (%.3f MB/s)" %
+          (numFiles, failures, totalBytes, elapsed,
+           totalBytes / elapsed / 1e6 if elapsed > 0 else 0.0))
+    return failures
+
+
+def initBatchWorker(options):
+    """Stores the expanded key and options in a batch worker process"""
+    global batchOptions
+    batchOptions = options
+
+
+def batchTask(inputPath, outputPath):
+    """Ciphers one file of a batch with the options stored by
+       initBatchWorker(). A partly written output file is removed if the
+       file fails. Returns the number of bytes read."""
+    directory = os.path.dirname(outputPath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    try:
+        with open(inputPath, "rb") as inputFile, \
+                open(outputPath, "wb") as outputFile:
+            cipherStream(inputFile, outputFile, *batchOptions, workers=1)
+            return inputFile.tell()
+    except BaseException:
+        if os.path.exists(outputPath):
+            os.remove(outputPath)
+        raise
+
+
+def cipherBytes(data, keySchedule, numRounds, mode, engine=Engine.TTABLE):
+    """Pads the input bytes, encrypts or decrypts them with the given engine
+       and strips the padding when decrypting."""
+    cipher = blockCipher(keySchedule, numRounds, mode, engine)
+    return b"".join(cipherChunks([data], cipher, mode))
+
+
+def blockCipher(keySchedule, numRounds, mode, engine):
+    """Returns a function cipher(src, dst=None, offset=0) that encrypts or
+       decrypts the whole 16-byte blocks in src with the given engine. The
+       result is written into the writable buffer dst at offset, or returned
+       in a new bytearray if dst is None. The key schedule is converted for
+       the engine once up front. The NumPy engine falls back to the T-table
+       engine when NumPy is not installed, and the bitsliced engine hands
+       calls with fewer than bitsliced.MIN_BLOCKS blocks to it."""
+    decrypt = mode is Mode.DECRYPT
+    if engine is Engine.BITSLICE:
+        keyBits = bitsliced.roundKeyBits(ttable.wordSchedule(keySchedule),
+                                         numRounds)
+        small = blockCipher(keySchedule, numRounds, mode, Engine.TTABLE)
+
+        def cipher(src, dst=None, offset=0):
+            if len(src) < bitsliced.MIN_BLOCKS * 16:
+                return small(src, dst, offset)
+            out = bitsliced.cipherBlocks(src, keyBits, numRounds, decrypt,
+                                         True)
+            if dst is None:
+                return out
+            dst[offset:offset + len(out)] = out
+        return cipher
+
+    if engine is Engine.NUMPY and vectorized.available():
+        rk = vectorized.roundKeyArray(keySchedule, numRounds)
+
+        def cipher(src, dst=None, offset=0):
+            out = vectorized.cipherBlocks(src, rk, numRounds, decrypt)
+            if dst is None:
+                return bytearray(out)
+            dst[offset:offset + len(out)] = out
+        return cipher
+
+    # The T-table engine reads and writes the plaintext side of each block
+    # row by row, matching inputToState() and the round functions in main()
+    rk = ttable.wordSchedule(keySchedule)
+    if decrypt:
+        rk = ttable.inverseWordSchedule(rk, numRounds)
+    blocks = ttable.decryptBlocks if decrypt else ttable.encryptBlocks
+
+    def cipher(src, dst=None, offset=0):
+        numBlocks = len(src) // 16
+        if dst is None:
+            out = bytearray(numBlocks * 16)
+            blocks(src, 0, out, 0, numBlocks, rk, numRounds, True)
+            return out
+        blocks(src, 0, dst, offset, numBlocks, rk, numRounds, True)
+    return cipher
+
+
 def inputKeyBytes(input, keySize):
     """Returns the input key as a list of 4-byte words"""
     inputBytes = []
@@ -154,41 +725,19 @@ def inputKeyBytes(input, keySize):
 
 
 def stateToOutput(state, outputFile, mode):
-    """Writes the resulting state to the output file"""
+    """Writes the resulting state to the output file in a single write. When
+       decrypting, any padding is stripped from the final block."""
+    output = bytearray()
+    for b in state:
+        if mode is Mode.ENCRYPT:
+            b = zip(b[0], b[1], b[2], b[3])
+        for row in b:
+            output += bytes(row)
+
     # If decrypting, remove any additional padding
     if mode is Mode.DECRYPT:
-        print(state)
-        totalLength = len(state) * 16
-        paddedBytes = state[len(state)-1][3][3]
-
-        flatState = []
-        for block in state:
-            for row in block:
-                for byte in row:
-                    flatState.append(byte)
-        padCount = 0
-        for i in range(len(flatState) - 1, -1, -1):
-            if flatState[i] == paddedBytes:
-                padCount += 1
-            else:
-                break
-        if padCount != paddedBytes:
-            paddedBytes = 0
-
-        outputLength = totalLength - paddedBytes
-        currentPos = 0
-        for b in state:
-            for row in b:
-                for byte in row:
-                    print(currentPos)
-                    if currentPos < outputLength:
-                        outputFile.write(byte.to_bytes(1, "big"))
-                        currentPos += 1
-    else:
-        for b in state:
-            block = [list(x) for x in zip(b[0], b[1], b[2], b[3])]
-            for row in block:
-                outputFile.write(bytes(row))
+        del output[len(output) - unpadLength(output[-17:]):]
+    outputFile.write(output)
 
 
 def byteToInt(byte):
@@ -335,5 +884,277 @@ def addRoundKey(block, keySchedule, i):
     return newBlock
 
 
+class AES:
+    """AES block cipher for a 128-bit or 256-bit key. The key is expanded
+       once into a flat array of 32-bit words for encryption; the one for
+       decryption is derived from it when first needed.
+       Instances are shared through a bounded LRU cache, so AES(key) with a
+       recently used key returns the existing instance. The cache is keyed
+       by a salted fingerprint of the key rather than the key itself, and
+       evictKey() removes a key and overwrites its schedules."""
+
+    # Guards taking and building the key schedules against wiping them
+    scheduleLock = threading.Lock()
+
+    def __new__(cls, key):
+        key = bytes(key)
+        fp = keyFingerprint(key)
+        with keyCacheLock:
+            cipher = keyCache.get(fp)
+            if cipher is not None:
+                keyCache.move_to_end(fp)
+                return cipher
+
+        cipher = super().__new__(cls)
+        cipher.expand(key, fp)
+        with keyCacheLock:
+            # Another thread may have expanded the same key meanwhile
+            if fp in keyCache:
+                keyCache.move_to_end(fp)
+                return keyCache[fp]
+            keyCache[fp] = cipher
+            # Keys dropped here may still be in use elsewhere, so they are
+            # left to the garbage collector; evictKey() wipes them
+            while len(keyCache) > KEY_CACHE_SIZE:
+                keyCache.popitem(last=False)
+        return cipher
+
+    def expand(self, key, fp):
+        """Expands the key into the encryption word schedule. The decryption
+           schedule is derived from it on first use, so that encrypting
+           never builds the decryption tables."""
+        if len(key) == 16:
+            keySize = KeySize.B128
+        elif len(key) == 32:
+            keySize = KeySize.B256
+        else:
+            raise ValueError("key must be 16 or 32 bytes")
+        self.fingerprint = fp
+        self.numRounds = 10 if keySize is KeySize.B128 else 14
+        keyWords = [list(key[i:i+4]) for i in range(0, len(key), 4)]
+        roundKeys = generateRoundKeys(keyWords, keySize)
+        keySchedule = [w for rk in roundKeys for w in rk]
+        words = ttable.wordSchedule(keySchedule[:(self.numRounds+1)*4])
+        self.rk = array("I", words)
+        self.inverseRk = None
+        self.wiped = False
+
+    def schedule(self, decrypt=False):
+        """Returns the encryption or decryption word schedule, building the
+           decryption one the first time it is used. Raises ValueError if
+           the schedules have been wiped."""
+        with self.scheduleLock:
+            self.check()
+            if not decrypt:
+                return self.rk
+            if self.inverseRk is None:
+                self.inverseRk = array("I", ttable.inverseWordSchedule(
+                    self.rk, self.numRounds))
+            return self.inverseRk
+
+    @property
+    def drk(self):
+        """The decryption word schedule, built the first time it is used"""
+        return self.schedule(True)
+
+    def __repr__(self):
+        return "AES(fingerprint=%s)" % self.fingerprint
+
+    def wipe(self):
+        """Overwrites the key schedules with zeros. The instance can no
+           longer be used afterwards, and a call that was using the
+           schedules meanwhile raises ValueError instead of returning its
+           result."""
+        with self.scheduleLock:
+            wipeSchedule(self.rk)
+            if self.inverseRk is not None:
+                wipeSchedule(self.inverseRk)
+            self.wiped = True
+
+    def check(self):
+        """Raises ValueError if the key schedules have been wiped. Every
+           cipher call checks again after it has run, as the schedules may
+           have been zeroed while it was using them."""
+        if self.wiped:
+            raise ValueError("key %s has been evicted" % self.fingerprint)
+
+    def encryptBlock(self, block):
+        """Encrypts a single 16-byte block"""
+        words = ttable.encryptBlock(*struct.unpack(">4I", block),
+                                    self.schedule(), self.numRounds)
+        self.check()
+        return struct.pack(">4I", *words)
+
+    def decryptBlock(self, block):
+        """Decrypts a single 16-byte block"""
+        words = ttable.decryptBlock(*struct.unpack(">4I", block),
+                                    self.schedule(True), self.numRounds)
+        self.check()
+        return struct.pack(">4I", *words)
+
+    def encryptInto(self, src, dst, srcOffset=0, dstOffset=0,
+                    numBlocks=None):
+        """Encrypts numBlocks whole blocks from src, starting at srcOffset,
+           into the writable buffer dst at dstOffset. By default every whole
+           block from srcOffset on is encrypted. Nothing is allocated per
+           block. If the key is wiped meanwhile, ValueError is raised and
+           what was written to dst must not be used."""
+        rk = self.schedule()
+        numBlocks = self.blockCount(src, dst, srcOffset, dstOffset, numBlocks)
+        ttable.encryptBlocks(src, srcOffset, dst, dstOffset, numBlocks,
+                             rk, self.numRounds)
+        self.check()
+
+    def decryptInto(self, src, dst, srcOffset=0, dstOffset=0,
+                    numBlocks=None):
+        """Decrypts numBlocks whole blocks from src, starting at srcOffset,
+           into the writable buffer dst at dstOffset. By default every whole
+           block from srcOffset on is decrypted. Nothing is allocated per
+           block. If the key is wiped meanwhile, ValueError is raised and
+           what was written to dst must not be used."""
+        drk = self.schedule(True)
+        numBlocks = self.blockCount(src, dst, srcOffset, dstOffset, numBlocks)
+        ttable.decryptBlocks(src, srcOffset, dst, dstOffset, numBlocks,
+                             drk, self.numRounds)
+        self.check()
+
+    def blockCount(self, src, dst, srcOffset, dstOffset, numBlocks):
+        """Returns the number of blocks for encryptInto() or decryptInto(),
+           raising ValueError if src or dst is too short"""
+        srcLength = memoryview(src).nbytes
+        if srcOffset < 0 or srcOffset > srcLength:
+            raise ValueError("source offset is outside the buffer")
+        if numBlocks is None:
+            numBlocks = (srcLength - srcOffset) // 16
+        if numBlocks < 0:
+            raise ValueError("numBlocks must not be negative")
+        if srcOffset + numBlocks * 16 > srcLength:
+            raise ValueError("source buffer is too short")
+        dstLength = memoryview(dst).nbytes
+        if dstOffset < 0 or dstOffset + numBlocks * 16 > dstLength:
+            raise ValueError("destination buffer is too short")
+        return numBlocks
+
+    def ctr(self, data, nonce, counter=0):
+        """Encrypts or decrypts data in CTR mode, starting at the given block
+           counter. The nonce must be modes.NONCE_SIZE bytes long."""
+        out = modes.ctrXor(data, nonce, counter, self.schedule(),
+                           self.numRounds)
+        self.check()
+        return out
+
+    def encryptCbc(self, data, iv):
+        """Pads and encrypts data in CBC mode"""
+        out = b"".join(modes.cbcEncryptChunks([data], self.schedule(),
+                                              self.numRounds, iv))
+        self.check()
+        return out
+
+    def decryptCbc(self, data, iv):
+        """Decrypts data in CBC mode and strips its padding"""
+        out = b"".join(modes.cbcDecryptChunks([data], self.schedule(True),
+                                              self.numRounds, iv, 1))
+        self.check()
+        return out
+
+    def encryptGcm(self, data, iv, aad=b""):
+        """Encrypts and authenticates data and aad in GCM mode, returning
+           the ciphertext followed by the 16-byte tag"""
+        out = gcm.encrypt(data, self.schedule(), self.numRounds, iv, aad)
+        self.check()
+        return out
+
+    def decryptGcm(self, data, iv, aad=b""):
+        """Checks the tag at the end of data and then decrypts it in GCM
+           mode. Raises ValueError if the tag does not match."""
+        out = gcm.decrypt(data, self.schedule(), self.numRounds, iv, aad)
+        self.check()
+        return out
+
+
+# LRU cache of expanded keys, from key fingerprint to AES instance
+keyCache = OrderedDict()
+keyCacheLock = threading.Lock()
+
+# Per-process salt, so that fingerprints cannot be matched against keys
+# outside this process
+fingerprintSalt = os.urandom(16)
+
+
+def keyFingerprint(key):
+    """Returns a short salted fingerprint identifying the key"""
+    digest = hmac.new(fingerprintSalt, bytes(key), hashlib.sha256)
+    return digest.hexdigest()[:16]
+
+
+def wipeSchedule(schedule):
+    """Overwrites a word schedule with zeros"""
+    for i in range(len(schedule)):
+        schedule[i] = 0
+
+
+def evictKey(key):
+    """Removes the key from the AES key cache and wipes its key schedules.
+       Returns True if the key was cached."""
+    with keyCacheLock:
+        cipher = keyCache.pop(keyFingerprint(key), None)
+    if cipher is None:
+        return False
+    cipher.wipe()
+    return True
+
+
+def clearKeyCache():
+    """Removes every key from the AES key cache and wipes their schedules"""
+    with keyCacheLock:
+        ciphers = list(keyCache.values())
+        keyCache.clear()
+    for cipher in ciphers:
+        cipher.wipe()
+
+
+def encryptMany(pairs):
+    """Encrypts many records, each with its own key, given as (key,
+       plaintext) pairs. Each plaintext must be a whole number of blocks and
+       is encrypted block by block as in ECB mode. The keys are expanded
+       together rather than one at a time, and nothing is added to the key
+       cache. Returns the ciphertexts in the order of pairs."""
+    return cipherMany(pairs, False)
+
+
+def decryptMany(pairs):
+    """Decrypts many records given as (key, ciphertext) pairs, as
+       encryptMany() encrypted them"""
+    return cipherMany(pairs, True)
+
+
+def cipherMany(pairs, decrypt):
+    """Ciphers (key, data) pairs in one pass per key length"""
+    pairs = list(pairs)
+    groups = {16: [], 32: []}
+    for i, (key, data) in enumerate(pairs):
+        if len(key) not in groups:
+            raise ValueError("key must be 16 or 32 bytes")
+        if len(data) % 16:
+            raise ValueError("record %d is not a whole number of blocks" % i)
+        groups[len(key)].append(i)
+
+    out = [None] * len(pairs)
+    for keyLength, indices in groups.items():
+        if not indices:
+            continue
+        # Every block is given its own copy of its record's key
+        data = b"".join(pairs[i][1] for i in indices)
+        keys = b"".join(bytes(pairs[i][0]) * (len(pairs[i][1]) // 16)
+                        for i in indices)
+        result = bitsliced.cipherBlocksKeyed(data, keys, keyLength, decrypt)
+        offset = 0
+        for i in indices:
+            size = len(pairs[i][1])
+            out[i] = bytes(result[offset:offset + size])
+            offset += size
+    return out
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
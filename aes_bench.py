@@ -0,0 +1,585 @@
+import sys
+import asyncio
+import getopt
+import io
+import json
+import os
+import platform
+import socket
+import tempfile
+import timeit
+import aiostream
+import bitsliced
+import container
+import modes
+from aes import *
+
+USAGE = ("Usage: python -m aes_bench [--engine ttable|numpy|bitslice] "
+         "[--sizes 16,1K,1M,100M] [--output $JSON] [--baseline $JSON] "
+         "[--threshold $FRACTION]")
+
+DEFAULT_SIZES = "16,1K,64K,1M,100M"
+DEFAULT_THRESHOLD = 0.10
+
+# FIPS-197 Appendix C example vectors as (key, plaintext, ciphertext)
+FIPS_VECTORS = (
+    ("000102030405060708090a0b0c0d0e0f",
+     "00112233445566778899aabbccddeeff",
+     "69c4e0d86a7b0430d8cdb78070b4c55a"),
+    ("000102030405060708090a0b0c0d0e0f101112131415161718191a1b1c1d1e1f",
+     "00112233445566778899aabbccddeeff",
+     "8ea2b7ca516745bfeafc49904b496089"),
+)
+
+# NIST SP 800-38A F.5.1 and F.5.5 CTR-AES vectors as (key, initial counter
+# block, plaintext, ciphertext)
+SP800_38A_PLAIN = ("6bc1bee22e409f96e93d7e117393172a"
+                   "ae2d8a571e03ac9c9eb76fac45af8e51"
+                   "30c81c46a35ce411e5fbc1191a0a52ef"
+                   "f69f2445df4f9b17ad2b417be66c3710")
+CTR_VECTORS = (
+    ("2b7e151628aed2a6abf7158809cf4f3c",
+     "f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff", SP800_38A_PLAIN,
+     "874d6191b620e3261bef6864990db6ce9806f66b7970fdff8617187bb9fffdff"
+     "5ae4df3edbd5d35e5b4f09020db03eab1e031dda2fbe03d1792170a0f3009cee"),
+    ("603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4",
+     "f0f1f2f3f4f5f6f7f8f9fafbfcfdfeff", SP800_38A_PLAIN,
+     "601ec313775789a5b7a7f504bbf3d228f443e3ca4d62b59aca84e990cacaf5c5"
+     "2b0930daa23de94ce87017ba2d84988ddfc9c58db67aada613c2dd08457941a6"),
+)
+
+# NIST SP 800-38A F.2.1 and F.2.5 CBC-AES vectors as (key, IV, plaintext,
+# ciphertext)
+CBC_VECTORS = (
+    ("2b7e151628aed2a6abf7158809cf4f3c",
+     "000102030405060708090a0b0c0d0e0f", SP800_38A_PLAIN,
+     "7649abac8119b246cee98e9b12e9197d5086cb9b507219ee95db113a917678b2"
+     "73bed6b8e3c1743b7116e69e222295163ff1caa1681fac09120eca307586e1a7"),
+    ("603deb1015ca71be2b73aef0857d77811f352c073b6108d72d9810a30914dff4",
+     "000102030405060708090a0b0c0d0e0f", SP800_38A_PLAIN,
+     "f58c4c04d6e5f1ba779eabfb5f7bfbd69cfc4e967edb808d679f777bc6702c7d"
+     "39f23369a9d9bacfa530e26304231461b2eb05e2c39be9fcda6c19078c6a9d1b"),
+)
+
+# GCM spec (McGrew and Viega) test cases 1 to 5 and 16 as (test case, key,
+# IV, plaintext, AAD, ciphertext, tag)
+GCM_KEY = "feffe9928665731c6d6a8f9467308308"
+GCM_PLAIN = ("d9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72"
+             "1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39")
+GCM_AAD = "feedfacedeadbeeffeedfacedeadbeefabaddad2"
+GCM_VECTORS = (
+    (1, "00000000000000000000000000000000", "000000000000000000000000", "",
+     "", "", "58e2fccefa7e3061367f1d57a4e7455a"),
+    (2, "00000000000000000000000000000000", "000000000000000000000000",
+     "00000000000000000000000000000000", "",
+     "0388dace60b6a392f328c2b971b2fe78", "ab6e47d42cec13bdf53a67b21257bddf"),
+    (3, GCM_KEY, "cafebabefacedbaddecaf888", GCM_PLAIN + "1aafd255", "",
+     "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+     "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091473f5985",
+     "4d5c2af327cd64a62cf35abd2ba6fab4"),
+    (4, GCM_KEY, "cafebabefacedbaddecaf888", GCM_PLAIN, GCM_AAD,
+     "42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e"
+     "21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091",
+     "5bc94fbc3221a5db94fae95ae7121a47"),
+    (5, GCM_KEY, "cafebabefacedbad", GCM_PLAIN, GCM_AAD,
+     "61353b4c2806934a777ff51fa22a4755699b2a714fcdc6f83766e5f97b6c7423"
+     "73806900e49f24b22b097544d4896b424989b5e1ebac0f07c23f4598",
+     "3612d2e79e3b0785561be14aaca2fccb"),
+    (16, GCM_KEY * 2, "cafebabefacedbaddecaf888", GCM_PLAIN, GCM_AAD,
+     "522dc1f099567d07f47f37a32a84427d643a8cdcbfe5c0c97598a2bd2555d1aa"
+     "8cb08e48590dbb3da7b08b1056828838c5f61e6393ba7a0abcc9f662",
+     "76fc6ece0f4e1768cddf8853bb2d551b"),
+)
+
+# Plaintext lengths for the round trip checks: empty, one block, a whole
+# container chunk, and lengths ending part way through a block and a chunk
+ROUND_TRIP_LENGTHS = (0, 16, 64, 100, 128, 200)
+ROUND_TRIP_CHUNK = 64
+
+ENGINES = {"ttable": Engine.TTABLE, "numpy": Engine.NUMPY,
+           "bitslice": Engine.BITSLICE}
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, "", ["engine=", "sizes=", "output=",
+                                          "baseline=", "threshold=",
+                                          "help"])
+
+    engine = Engine.BITSLICE
+    sizes = parseSizes(DEFAULT_SIZES)
+    outputPath = None
+    baselinePath = None
+    threshold = DEFAULT_THRESHOLD
+
+    for opt, arg in opts:
+        if opt == "--engine":
+            engine = ENGINES[arg]
+        elif opt == "--sizes":
+            sizes = parseSizes(arg)
+        elif opt == "--output":
+            outputPath = arg
+        elif opt == "--baseline":
+            baselinePath = arg
+        elif opt == "--threshold":
+            threshold = float(arg)
+        elif opt == "--help":
+            print(USAGE)
+            sys.exit()
+
+    # Numbers are only comparable when measured the same way, so the
+    # baseline is checked before spending time on the benchmarks
+    baseline = None
+    if baselinePath:
+        with open(baselinePath) as f:
+            baseline = json.load(f)
+        baselineEngine = baseline.get("engine", engine.name.lower())
+        if baselineEngine != engine.name.lower():
+            sys.exit("baseline was measured with the %s engine, not %s" %
+                     (baselineEngine, engine.name.lower()))
+        if baseline.get("python") != platform.python_version():
+            print("warning: baseline was measured with Python %s, not %s" %
+                  (baseline.get("python"), platform.python_version()),
+                  file=sys.stderr)
+
+    # Never report numbers for an engine that gives the wrong answer
+    errors = (checkVectors(engine) + checkModeVectors() +
+              checkRoundTrips(engine))
+    if errors:
+        for error in errors:
+            print("FAIL", error)
+        sys.exit(2)
+    print("FIPS-197 Appendix C, cipher mode vectors and round trips: ok")
+
+    results = {}
+    results.update(microBenchmarks())
+    results.update(throughputBenchmarks(engine, sizes))
+
+    report = {"python": platform.python_version(),
+              "engine": engine.name.lower(),
+              "results": results}
+    if outputPath:
+        with open(outputPath, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline["results"], threshold)
+        for name, old, new in regressions:
+            print("REGRESSION %s: %.3f -> %.3f" % (name, old, new))
+        if regressions:
+            sys.exit(1)
+
+
+def parseSizes(text):
+    """Parses a comma separated list of sizes such as 16,1K,1M"""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    sizes = []
+    for size in text.split(","):
+        size = size.strip().upper().rstrip("B")
+        if size[-1] in units:
+            sizes.append(int(size[:-1]) * units[size[-1]])
+        else:
+            sizes.append(int(size))
+    return sizes
+
+
+def transposeBlock(block):
+    """Transposes a 16-byte block, converting between the row by row layout
+       used by the CLI's ECB path and the FIPS-197 column by column layout"""
+    return bytes(block[4 * (i % 4) + i // 4] for i in range(16))
+
+
+def keyScheduleFor(key):
+    """Returns the CLI key schedule and number of rounds for a raw key"""
+    keySize = KeySize.B128 if len(key) == 16 else KeySize.B256
+    numRounds = 10 if keySize is KeySize.B128 else 14
+    roundKeys = generateRoundKeys([list(key[i:i+4])
+                                   for i in range(0, len(key), 4)], keySize)
+    keySchedule = [w for rk in roundKeys for w in rk][:(numRounds+1)*4]
+    return keySchedule, numRounds
+
+
+def checkVectors(engine):
+    """Checks the AES class and the CLI's ECB path with the given engine
+       against the FIPS-197 vectors. The engine is given a run of copies of
+       each block, so that engines which batch blocks are checked too.
+       Returns a list of failures."""
+    errors = []
+    for key, plain, expected in FIPS_VECTORS:
+        key, plain, expected = (bytes.fromhex(key), bytes.fromhex(plain),
+                                bytes.fromhex(expected))
+        name = "AES-%d" % (len(key) * 8)
+
+        cipher = AES(key)
+        if cipher.encryptBlock(plain) != expected:
+            errors.append("%s AES.encryptBlock" % name)
+        if cipher.decryptBlock(expected) != plain:
+            errors.append("%s AES.decryptBlock" % name)
+
+        keySchedule, numRounds = keyScheduleFor(key)
+        encrypt = blockCipher(keySchedule, numRounds, Mode.ENCRYPT, engine)
+        decrypt = blockCipher(keySchedule, numRounds, Mode.DECRYPT, engine)
+        n = bitsliced.MIN_BLOCKS
+        if bytes(encrypt(transposeBlock(plain) * n)) != expected * n:
+            errors.append("%s %s encrypt" % (name, engine.name.lower()))
+        if bytes(decrypt(expected * n)) != transposeBlock(plain) * n:
+            errors.append("%s %s decrypt" % (name, engine.name.lower()))
+    return errors
+
+
+def checkModeVectors():
+    """Checks the cipher modes against their published vectors. Returns a
+       list of failures."""
+    return checkCtrVectors() + checkCbcVectors() + checkGcmVectors()
+
+
+def checkCtrVectors():
+    """Checks CTR mode against the SP 800-38A vectors, both on its own and
+       at the end of a run long enough for the bitsliced keystream. Returns
+       a list of failures."""
+    errors = []
+    for key, counter, plain, expected in CTR_VECTORS:
+        key, counter, plain, expected = (bytes.fromhex(key),
+                                         bytes.fromhex(counter),
+                                         bytes.fromhex(plain),
+                                         bytes.fromhex(expected))
+        name = "AES-%d CTR" % (len(key) * 8)
+        cipher = AES(key)
+        nonce = counter[:modes.NONCE_SIZE]
+        start = int.from_bytes(counter[modes.NONCE_SIZE:], "big")
+        if cipher.ctr(plain, nonce, start) != expected:
+            errors.append("%s encrypt" % name)
+        if cipher.ctr(expected, nonce, start) != plain:
+            errors.append("%s decrypt" % name)
+        skip = bitsliced.MIN_BLOCKS * 16
+        out = cipher.ctr(bytes(skip) + plain, nonce, start - skip // 16)
+        if out[skip:] != expected:
+            errors.append("%s bitslice" % name)
+    return errors
+
+
+def checkCbcVectors():
+    """Checks CBC mode against the SP 800-38A vectors. The vectors are
+       unpadded, so the padded AES methods are checked on the blocks before
+       the padding block. Returns a list of failures."""
+    errors = []
+    for key, iv, plain, expected in CBC_VECTORS:
+        key, iv, plain, expected = (bytes.fromhex(key), bytes.fromhex(iv),
+                                    bytes.fromhex(plain),
+                                    bytes.fromhex(expected))
+        name = "AES-%d CBC" % (len(key) * 8)
+        cipher = AES(key)
+        encrypted = cipher.encryptCbc(plain, iv)
+        if encrypted[:len(expected)] != expected:
+            errors.append("%s encrypt" % name)
+        if modes.cbcDecrypt(expected, iv, cipher.drk,
+                            cipher.numRounds) != plain:
+            errors.append("%s decrypt" % name)
+        if cipher.decryptCbc(encrypted, iv) != plain:
+            errors.append("%s padded decrypt" % name)
+    return errors
+
+
+def checkGcmVectors():
+    """Checks GCM mode against the test cases from the GCM spec, including
+       that a changed tag is rejected. Returns a list of failures."""
+    errors = []
+    for case, *vector in GCM_VECTORS:
+        key, iv, plain, aad, expected, tag = (bytes.fromhex(v)
+                                              for v in vector)
+        name = "AES-%d GCM test case %d" % (len(key) * 8, case)
+        cipher = AES(key)
+        if cipher.encryptGcm(plain, iv, aad) != expected + tag:
+            errors.append("%s encrypt" % name)
+        try:
+            if cipher.decryptGcm(expected + tag, iv, aad) != plain:
+                errors.append("%s decrypt" % name)
+        except ValueError:
+            errors.append("%s decrypt" % name)
+        forged = expected + tag[:-1] + bytes([tag[-1] ^ 1])
+        try:
+            cipher.decryptGcm(forged, iv, aad)
+            errors.append("%s forged tag accepted" % name)
+        except ValueError:
+            pass
+    return errors
+
+
+def checkRoundTrips(engine):
+    """Checks that what each file format writes reads back the same.
+       Returns a list of failures."""
+    return checkContainer() + checkStream() + checkMmap(engine)
+
+
+def roundTripData(length):
+    """Returns length bytes of plaintext with no repeated blocks"""
+    return bytes((i * 7 + i // 256) & 0xFF for i in range(length))
+
+
+def splitChunks(data, size=37):
+    """Cuts data into chunks of an odd size, so that chunk boundaries fall
+       part way through blocks"""
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def checkContainer():
+    """Checks containers in both modes: full decryption, decryptRange()
+       against slicing the plaintext for ranges around block and chunk
+       boundaries and the end of the plaintext, and for CBC that each chunk
+       decrypts on its own from its chunk IV (the base IV with the chunk
+       number XOR'd into its last 8 bytes, encrypted) and only the last one
+       is padded. Returns a list of failures."""
+    errors = []
+    cipher = AES(bytes.fromhex(FIPS_VECTORS[0][0]))
+    rk, drk, numRounds = (cipher.schedule(), cipher.schedule(True),
+                          cipher.numRounds)
+    for cipherMode in (container.MODE_CTR, container.MODE_CBC):
+        modeName = "CTR" if cipherMode == container.MODE_CTR else "CBC"
+        for length in ROUND_TRIP_LENGTHS:
+            name = "container %s length %d" % (modeName, length)
+            plain = roundTripData(length)
+            header = container.newHeader(cipherMode, ROUND_TRIP_CHUNK)
+            body = b"".join(container.encryptChunks(
+                splitChunks(plain), rk, numRounds, header, 1))
+            out = b"".join(container.decryptChunks(
+                splitChunks(body), rk, numRounds, header, 1))
+            if out != plain:
+                errors.append("%s decrypt" % name)
+
+            if cipherMode == container.MODE_CBC:
+                _, chunkSize, iv = container.parseHeader(header)
+                padded = modes.pkcs7Pad(plain)
+                if len(body) != len(padded):
+                    errors.append("%s padding" % name)
+                for index in range(0, len(body), chunkSize):
+                    number = (index // chunkSize).to_bytes(8, "big")
+                    chunkIV = cipher.encryptBlock(
+                        iv[:8] + bytes(a ^ b for a, b in zip(iv[8:], number)))
+                    chunk = modes.cbcDecrypt(body[index:index + chunkSize],
+                                             chunkIV, drk, numRounds)
+                    if chunk != padded[index:index + chunkSize]:
+                        errors.append("%s chunk %d" %
+                                      (name, index // chunkSize))
+
+            points = sorted({0, 1, 15, 16, 17, 63, 64, 65, length // 2,
+                             length - 1, length, length + 10} - {-1})
+            with tempfile.TemporaryFile() as f:
+                f.write(header + body)
+                f.flush()
+                for start in points:
+                    for end in points + [None]:
+                        data = container.decryptRange(f, rk, numRounds,
+                                                      start, end)
+                        if data != plain[start:end]:
+                            errors.append("%s range %d:%s" %
+                                          (name, start, end))
+    return errors
+
+
+def checkStream():
+    """Checks AESStreamWriter and AESStreamReader in both modes over a
+       socket pair: what is sent must match the command line tool's layout
+       and read back the same, including a stream long enough to be
+       ciphered in the executor, and a CBC stream cut short part way
+       through a block must be rejected. Returns a list of failures."""
+    errors = []
+    key = bytes.fromhex(FIPS_VECTORS[0][0])
+    cipher = AES(key)
+
+    # One end of each socket pair is wrapped in a stream, and the other is
+    # read or written directly
+    async def send(plain, cipherMode):
+        loop = asyncio.get_running_loop()
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        _, writer = await asyncio.open_connection(sock=a)
+        stream = aiostream.AESStreamWriter(writer, key, cipherMode)
+
+        async def write():
+            for chunk in splitChunks(plain, 1000):
+                stream.write(chunk)
+                await stream.drain()
+            await stream.close()
+
+        async def read():
+            chunks = []
+            chunk = await loop.sock_recv(b, 1 << 16)
+            while chunk:
+                chunks.append(chunk)
+                chunk = await loop.sock_recv(b, 1 << 16)
+            b.close()
+            return b"".join(chunks)
+        _, sent = await asyncio.gather(write(), read())
+        return sent
+
+    async def receive(sent, cipherMode):
+        loop = asyncio.get_running_loop()
+        a, b = socket.socketpair()
+        b.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=a)
+        stream = aiostream.AESStreamReader(reader, key, cipherMode)
+
+        async def write():
+            await loop.sock_sendall(b, sent)
+            b.close()
+
+        async def read():
+            chunks = []
+            chunk = await stream.read(999)
+            while chunk:
+                chunks.append(chunk)
+                chunk = await stream.read(999)
+            return b"".join(chunks)
+        try:
+            _, received = await asyncio.gather(write(), read())
+        finally:
+            writer.close()
+        return received
+
+    async def run():
+        lengths = ROUND_TRIP_LENGTHS + (3 * aiostream.EXECUTOR_BYTES + 5,)
+        for cipherMode in (CipherMode.CTR, CipherMode.CBC):
+            for length in lengths:
+                name = "stream %s length %d" % (cipherMode.name, length)
+                plain = roundTripData(length)
+                sent = await send(plain, cipherMode)
+                if cipherMode is CipherMode.CTR:
+                    nonce = sent[:modes.NONCE_SIZE]
+                    expected = nonce + cipher.ctr(plain, nonce)
+                else:
+                    iv = sent[:modes.IV_SIZE]
+                    expected = iv + cipher.encryptCbc(plain, iv)
+                if sent != expected:
+                    errors.append("%s encrypt" % name)
+                if await receive(sent, cipherMode) != plain:
+                    errors.append("%s decrypt" % name)
+                if cipherMode is CipherMode.CBC:
+                    try:
+                        await receive(sent[:-1], cipherMode)
+                        errors.append("%s truncated stream accepted" % name)
+                    except ValueError:
+                        pass
+
+    asyncio.run(run())
+    return errors
+
+
+def checkMmap(engine):
+    """Checks memory-mapped and in place ECB encryption with the given
+       engine against streaming the same file, for lengths around block and
+       chunk boundaries, and that both decrypt back to the plaintext.
+       Returns a list of failures."""
+    errors = []
+    keySchedule, numRounds = keyScheduleFor(bytes.fromhex(FIPS_VECTORS[0][0]))
+    encrypt = blockCipher(keySchedule, numRounds, Mode.ENCRYPT, engine)
+    decrypt = blockCipher(keySchedule, numRounds, Mode.DECRYPT, engine)
+    with tempfile.TemporaryDirectory() as directory:
+        plainPath = os.path.join(directory, "plain")
+        cipherPath = os.path.join(directory, "cipher")
+        outPath = os.path.join(directory, "out")
+        for length in ROUND_TRIP_LENGTHS + (1000,):
+            name = "mmap %s length %d" % (engine.name.lower(), length)
+            plain = roundTripData(length)
+            expected = io.BytesIO()
+            cipherStream(io.BytesIO(plain), expected, keySchedule, numRounds,
+                         Mode.ENCRYPT, engine, chunkSize=ROUND_TRIP_CHUNK)
+            expected = expected.getvalue()
+
+            with open(plainPath, "wb") as f:
+                f.write(plain)
+            mmapCipher(plainPath, cipherPath, encrypt, Mode.ENCRYPT,
+                       ROUND_TRIP_CHUNK)
+            with open(cipherPath, "rb") as f:
+                if f.read() != expected:
+                    errors.append("%s encrypt" % name)
+            mmapCipher(cipherPath, outPath, decrypt, Mode.DECRYPT,
+                       ROUND_TRIP_CHUNK)
+            with open(outPath, "rb") as f:
+                if f.read() != plain:
+                    errors.append("%s decrypt" % name)
+
+            mmapCipher(plainPath, None, encrypt, Mode.ENCRYPT,
+                       ROUND_TRIP_CHUNK)
+            with open(plainPath, "rb") as f:
+                if f.read() != expected:
+                    errors.append("%s in place encrypt" % name)
+            mmapCipher(plainPath, None, decrypt, Mode.DECRYPT,
+                       ROUND_TRIP_CHUNK)
+            with open(plainPath, "rb") as f:
+                if f.read() != plain:
+                    errors.append("%s in place decrypt" % name)
+    return errors
+
+
+def timePerCall(func, minTime=0.2):
+    """Returns the best time in seconds for one call of func. Calls that
+       take longer than minTime on their own are only timed once."""
+    timer = timeit.Timer(func)
+    elapsed = timer.timeit(1)
+    if elapsed >= minTime:
+        return elapsed
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * minTime / max(elapsed, 1e-9)))
+    return min(timer.repeat(3, number)) / number
+
+
+def microBenchmarks():
+    """Times the individual round functions and key expansion. Results are
+       in calls per second."""
+    key = os.urandom(16)
+    keyWords = [list(key[i:i+4]) for i in range(0, 16, 4)]
+    keySchedule, numRounds = keyScheduleFor(key)
+    block = [list(os.urandom(4)) for _ in range(4)]
+
+    benchmarks = {
+        "subBytes": lambda: subBytes(block, Mode.ENCRYPT),
+        "shiftRows": lambda: shiftRows(block, Mode.ENCRYPT),
+        "mixColumns": lambda: mixColumns(block, Mode.ENCRYPT),
+        "addRoundKey": lambda: addRoundKey(block, keySchedule, 1),
+        "generateRoundKeys": lambda: generateRoundKeys(keyWords,
+                                                       KeySize.B128),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        seconds = timePerCall(func)
+        results["micro/%s" % name] = 1 / seconds
+        print("%-20s %10.2f us/call" % (name, seconds * 1e6))
+    return results
+
+
+def throughputBenchmarks(engine, sizes):
+    """Times end-to-end ECB encryption and decryption of each input size at
+       both key sizes. Results are in MB/s."""
+    results = {}
+    for keyLength in (16, 32):
+        keySchedule, numRounds = keyScheduleFor(os.urandom(keyLength))
+        for size in sizes:
+            plain = os.urandom(size)
+            encrypted = cipherBytes(plain, keySchedule, numRounds,
+                                    Mode.ENCRYPT, engine)
+            for mode, data in ((Mode.ENCRYPT, plain),
+                               (Mode.DECRYPT, encrypted)):
+                seconds = timePerCall(
+                    lambda: cipherBytes(data, keySchedule, numRounds, mode,
+                                        engine))
+                mbps = size / seconds / 1e6
+                name = "%s/aes%d/%d" % (mode.name.lower(), keyLength * 8,
+                                        size)
+                results[name] = mbps
+                print("%-28s %10.3f MB/s" % (name, mbps))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns (name, baseline, result) for every result that is more than
+       threshold (a fraction) below its baseline. Higher is better for every
+       result."""
+    regressions = []
+    for name, old in sorted(baseline.items()):
+        new = results.get(name)
+        if new is not None and new < old * (1 - threshold):
+            regressions.append((name, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,262 @@
+import asyncio
+import struct
+import time
+from collections import deque
+import modes
+from aes import AES, CipherMode
+
+# Batches of at least this many bytes are ciphered in an executor so that
+# the event loop keeps running; smaller ones are ciphered straight away
+EXECUTOR_BYTES = 1 << 14
+
+# Bytes requested from the underlying reader at a time
+READ_SIZE = 1 << 16
+
+# Number of recent per-chunk latencies kept for latency()
+LATENCY_SAMPLES = 1024
+
+
+async def runCipher(executor, func, *args):
+    """Runs func(*args) in the executor if the batch is large enough to be
+       worth moving off the event loop, and directly otherwise"""
+    if len(args[0]) >= EXECUTOR_BYTES:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, func, *args)
+    return func(*args)
+
+
+def latencySummary(samples):
+    """Returns the count, mean, median, 99th percentile and maximum of a
+       list of latencies in seconds"""
+    if not samples:
+        return {"count": 0, "mean": 0.0, "p50": 0.0, "p99": 0.0,
+                "max": 0.0}
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {"count": n, "mean": sum(ordered) / n,
+            "p50": ordered[(n - 1) // 2],
+            "p99": ordered[min(n - 1, (n * 99) // 100)],
+            "max": ordered[-1]}
+
+
+class AESStreamWriter:
+    """Wraps an asyncio.StreamWriter, encrypting everything written to it in
+       CTR or CBC mode. As with StreamWriter, write() only buffers and
+       drain() does the work: it encrypts whatever has been written so far,
+       passes it on and waits for the underlying writer to drain, which
+       gives backpressure. The nonce or IV is sent first, in the same layout
+       as the command line tool. CTR mode sends every byte on the next
+       drain(); CBC mode holds back a partial final block until close()
+       pads it. Batches of EXECUTOR_BYTES or more are ciphered in executor
+       (the loop's default executor if None). The workers of a process pool
+       executor should be started before any connection is opened, or the
+       forked workers keep its socket open."""
+
+    def __init__(self, writer, key, cipherMode=CipherMode.CTR, executor=None):
+        if cipherMode not in (CipherMode.CTR, CipherMode.CBC):
+            raise ValueError("only CTR and CBC modes can be streamed")
+        self.writer = writer
+        self.cipher = AES(key)
+        self.cipherMode = cipherMode
+        self.executor = executor
+        self.pending = bytearray()
+        self.pendingSince = None
+        self.lock = asyncio.Lock()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.closed = False
+        if cipherMode is CipherMode.CTR:
+            self.nonce = modes.newNonce()
+            self.offset = 0
+            writer.write(self.nonce)
+        else:
+            iv = modes.newIV()
+            self.prev = struct.unpack(">4I", iv)
+            writer.write(iv)
+
+    def write(self, data):
+        """Buffers data to be encrypted by the next drain()"""
+        if self.closed:
+            raise ValueError("write to a closed AESStreamWriter")
+        if self.pendingSince is None:
+            self.pendingSince = time.perf_counter()
+        self.pending += data
+
+    async def drain(self):
+        """Encrypts the buffered data, writes it to the underlying writer and
+           waits until it is drained"""
+        async with self.lock:
+            await self.flush()
+
+    async def flush(self, final=False):
+        """Encrypts and sends the buffer, padding it if final is True"""
+        if self.cipherMode is CipherMode.CTR:
+            data = bytes(self.pending)
+            del self.pending[:]
+        else:
+            end = len(self.pending) - len(self.pending) % 16
+            data = bytes(self.pending[:end])
+            del self.pending[:end]
+            if final:
+                data += modes.pkcs7Pad(bytes(self.pending))
+                del self.pending[:]
+        since = self.pendingSince
+        self.pendingSince = time.perf_counter() if self.pending else None
+        if not data:
+            return
+
+        cipher = self.cipher
+        rk = cipher.schedule()
+        if self.cipherMode is CipherMode.CTR:
+            # Only whole blocks have their own counter, so a write that
+            # starts part way into a block is aligned with zero bytes
+            skip = self.offset % 16
+            out = await runCipher(self.executor, modes.ctrXor,
+                                  bytes(skip) + data, self.nonce,
+                                  self.offset // 16, rk, cipher.numRounds)
+            out = out[skip:]
+            self.offset += len(data)
+        else:
+            out, self.prev = await runCipher(self.executor, modes.cbcEncrypt,
+                                             data, rk, cipher.numRounds,
+                                             self.prev)
+        cipher.check()
+        self.writer.write(out)
+        await self.writer.drain()
+        if since is not None:
+            self.latencies.append(time.perf_counter() - since)
+
+    async def close(self):
+        """Sends any buffered data, with CBC padding, and closes the
+           underlying writer"""
+        async with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            await self.flush(final=True)
+        self.writer.close()
+        await self.writer.wait_closed()
+
+    def latency(self):
+        """Returns latencySummary() of the time from each chunk being
+           written to it being drained"""
+        return latencySummary(list(self.latencies))
+
+
+class AESStreamReader:
+    """Wraps an asyncio.StreamReader, decrypting a stream written by
+       AESStreamWriter. Data is only read from the underlying reader when
+       read() is called, so a slow consumer slows the sender down. In CBC
+       mode the last block is held back until the end of the stream so its
+       padding can be checked, and ValueError is raised if it is
+       malformed. The executor is used as by AESStreamWriter."""
+
+    def __init__(self, reader, key, cipherMode=CipherMode.CTR,
+                 executor=None):
+        if cipherMode not in (CipherMode.CTR, CipherMode.CBC):
+            raise ValueError("only CTR and CBC modes can be streamed")
+        self.reader = reader
+        self.cipher = AES(key)
+        self.cipherMode = cipherMode
+        self.executor = executor
+        self.header = None
+        self.pending = b""
+        self.ready = b""
+        self.offset = 0
+        self.eof = False
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def readHeader(self):
+        """Reads the nonce or IV at the start of the stream"""
+        size = (modes.NONCE_SIZE if self.cipherMode is CipherMode.CTR
+                else modes.IV_SIZE)
+        try:
+            self.header = await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise ValueError("stream ended before its nonce or IV")
+        self.prev = self.header
+
+    async def read(self, n=-1):
+        """Returns up to n decrypted bytes, or everything up to the end of
+           the stream if n is -1. Returns b"" at the end of the stream."""
+        if self.header is None:
+            await self.readHeader()
+        if n < 0:
+            chunks = []
+            chunk = await self.read(READ_SIZE)
+            while chunk:
+                chunks.append(chunk)
+                chunk = await self.read(READ_SIZE)
+            return b"".join(chunks)
+
+        while not self.ready and not self.eof:
+            data = await self.reader.read(max(n, 16))
+            start = time.perf_counter()
+            if data:
+                self.ready = await self.decrypt(data)
+            else:
+                self.eof = True
+                self.ready = self.finish()
+            if self.ready:
+                self.latencies.append(time.perf_counter() - start)
+        out = self.ready[:n]
+        self.ready = self.ready[n:]
+        return out
+
+    async def decrypt(self, data):
+        """Decrypts the next data from the stream, returning what can be
+           released so far"""
+        cipher = self.cipher
+        if self.cipherMode is CipherMode.CTR:
+            skip = self.offset % 16
+            out = await runCipher(self.executor, modes.ctrXor,
+                                  bytes(skip) + data, self.header,
+                                  self.offset // 16, cipher.schedule(),
+                                  cipher.numRounds)
+            cipher.check()
+            self.offset += len(data)
+            return out[skip:]
+
+        # Keep the last whole block back, as it may be the padding block
+        data = self.pending + data
+        end = len(data) - len(data) % 16
+        if end == len(data):
+            end -= 16
+        self.pending = data[end:]
+        if end <= 0:
+            return b""
+        data = data[:end]
+        out = await runCipher(self.executor, modes.cbcDecrypt, data,
+                              self.prev, cipher.schedule(True),
+                              cipher.numRounds)
+        cipher.check()
+        self.prev = data[-16:]
+        return out
+
+    def finish(self):
+        """Decrypts and unpads the block held back at the end of a CBC
+           stream. Raises ValueError if the stream did not end on a block
+           boundary."""
+        if self.cipherMode is CipherMode.CTR:
+            return b""
+        if len(self.pending) != 16:
+            raise ValueError("ciphertext is not a whole number of blocks")
+        cipher = self.cipher
+        out = modes.cbcDecrypt(self.pending, self.prev, cipher.schedule(True),
+                               cipher.numRounds)
+        cipher.check()
+        self.pending = b""
+        return modes.pkcs7Unpad(out)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        chunk = await self.read(READ_SIZE)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    def latency(self):
+        """Returns latencySummary() of the time taken to decrypt each chunk
+           once it has arrived"""
+        return latencySummary(list(self.latencies))
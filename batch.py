@@ -0,0 +1,96 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Characters that make --inputdir a glob pattern rather than a directory
+GLOB_CHARS = "*?["
+
+
+def findInputs(inputDir=None, manifest=None, outputDir=None):
+    """Returns the directory the input files are named relative to, and the
+       files themselves. inputDir is either a directory, which is searched
+       recursively, or a glob pattern; manifest is a file listing one input
+       per line, where blank lines and lines starting with # are skipped.
+       Files inside outputDir are left out."""
+    if manifest is not None:
+        with open(manifest) as f:
+            paths = [line.strip() for line in f]
+        paths = [p for p in paths if p and not p.startswith("#")]
+        root = None
+    elif any(c in inputDir for c in GLOB_CHARS):
+        paths = sorted(p for p in glob.glob(inputDir, recursive=True)
+                       if os.path.isfile(p))
+        root = None
+    else:
+        paths = []
+        for dirPath, dirNames, fileNames in os.walk(inputDir):
+            dirNames.sort()
+            paths.extend(os.path.join(dirPath, name)
+                         for name in sorted(fileNames))
+        root = inputDir
+
+    if outputDir is not None:
+        outputDir = os.path.abspath(outputDir) + os.sep
+        paths = [p for p in paths
+                 if not os.path.abspath(p).startswith(outputDir)]
+    if root is None:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(p))
+                                   for p in paths]) if paths else "."
+    return root, paths
+
+
+def outputPathFor(inputPath, root, outputDir):
+    """Returns the output path for an input file, keeping its path relative
+       to root under outputDir"""
+    relPath = os.path.relpath(os.path.abspath(inputPath),
+                              os.path.abspath(root))
+    return os.path.join(outputDir, relPath)
+
+
+def runJob(task, inputPath, outputPath):
+    """Runs task(inputPath, outputPath) and returns its result, the time it
+       took and an error message, or None if it succeeded. Errors are
+       returned as text so that any failure can be passed back from a worker
+       process."""
+    start = time.perf_counter()
+    try:
+        result = task(inputPath, outputPath)
+        error = None
+    except Exception as e:
+        result = None
+        error = "%s: %s" % (type(e).__name__, e)
+    return result, time.perf_counter() - start, error
+
+
+def runBatch(jobs, task, initializer, initargs, workers=None):
+    """Runs task(inputPath, outputPath) for each (inputPath, outputPath) in
+       jobs over a pool of worker processes that each run
+       initializer(*initargs) once. Yields (inputPath, result, seconds,
+       error) for each job as it finishes, so one failed job does not stop
+       the others. With one worker everything runs in this process, and
+       with no workers given, one is started per CPU."""
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1")
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        initializer(*initargs)
+        for inputPath, outputPath in jobs:
+            yield (inputPath,) + runJob(task, inputPath, outputPath)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=initializer,
+                             initargs=initargs) as pool:
+        pending = {}
+        jobs = iter(jobs)
+        while True:
+            for inputPath, outputPath in jobs:
+                future = pool.submit(runJob, task, inputPath, outputPath)
+                pending[future] = inputPath
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield (pending.pop(future),) + future.result()
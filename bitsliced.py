@@ -0,0 +1,426 @@
+from constants import *
+import tables
+
+# Number of blocks processed per batch; bounds the size of each bit slice
+BATCH_BLOCKS = 1 << 16
+
+# Inputs of at least this many blocks are worth the cost of slicing them;
+# smaller ones are faster with the T-table engine
+MIN_BLOCKS = 256
+
+# Bit b of byte p of a block is stored in slice 8p + b, with bytes numbered
+# column by column so that byte r + 4c is row r, column c
+SHIFT_ROWS = [r + 4 * ((c + r) % 4) for c in range(4) for r in range(4)]
+INV_SHIFT_ROWS = [r + 4 * ((c - r) % 4) for c in range(4) for r in range(4)]
+TRANSPOSE = [4 * r + c for c in range(4) for r in range(4)]
+IDENTITY = list(range(16))
+
+
+def packTables():
+    """Returns the translate tables for pack(), one for each bit b, mapping
+       a byte to bit b of it"""
+    return [(v >> b) & 1 for b in range(8) for v in range(256)]
+
+
+def unpackTables():
+    """Returns the translate tables for unpack(), one for each k and b,
+       mapping a byte to bit k of it moved to bit b"""
+    return [((v >> k) & 1) << b for k in range(8) for b in range(8)
+            for v in range(256)]
+
+
+def splitPack(values):
+    """Splits the pack() tables into a list of 8 translate tables"""
+    return [values[b * 256:(b + 1) * 256].tobytes() for b in range(8)]
+
+
+def splitUnpack(values):
+    """Splits the unpack() tables into lists of translate tables indexed
+       [k][b]"""
+    return [[values[(8 * k + b) * 256:(8 * k + b + 1) * 256].tobytes()
+             for b in range(8)] for k in range(8)]
+
+
+# SHA-256 of each cached table, checked whenever it is loaded or built
+PACK_DIGEST = (
+    "adf61161dc423d700189a3748eeb4b17b0bea276a3473232ce48ec3cdfcaecfb")
+UNPACK_DIGEST = (
+    "92da55e440e1e13e76dbfc8193f1ebf170a473f3b2c165c658df5c00ca73092e")
+
+tables.register("PACK", "B", packTables, splitPack, PACK_DIGEST)
+tables.register("UNPACK", "B", unpackTables, splitUnpack, UNPACK_DIGEST)
+
+
+def sbox(a, ones):
+    """Computes SubBytes on one byte position held as 8 bit slices, least
+       significant bit first, with the 113 gate circuit of Boyar and
+       Peralta. ones is a slice with every bit set."""
+    U0, U1, U2, U3, U4, U5, U6, U7 = a[7], a[6], a[5], a[4], a[3], a[2], \
+        a[1], a[0]
+
+    T1 = U0 ^ U3
+    T2 = U0 ^ U5
+    T3 = U0 ^ U6
+    T4 = U3 ^ U5
+    T5 = U4 ^ U6
+    T6 = T1 ^ T5
+    T7 = U1 ^ U2
+    T8 = U7 ^ T6
+    T9 = U7 ^ T7
+    T10 = T6 ^ T7
+    T11 = U1 ^ U5
+    T12 = U2 ^ U5
+    T13 = T3 ^ T4
+    T14 = T6 ^ T11
+    T15 = T5 ^ T11
+    T16 = T5 ^ T12
+    T17 = T9 ^ T16
+    T18 = U3 ^ U7
+    T19 = T7 ^ T18
+    T20 = T1 ^ T19
+    T21 = U6 ^ U7
+    T22 = T7 ^ T21
+    T23 = T2 ^ T22
+    T24 = T2 ^ T10
+    T25 = T20 ^ T17
+    T26 = T3 ^ T16
+    T27 = T1 ^ T12
+
+    M1 = T13 & T6
+    M2 = T23 & T8
+    M3 = T14 ^ M1
+    M4 = T19 & U7
+    M5 = M4 ^ M1
+    M6 = T3 & T16
+    M7 = T22 & T9
+    M8 = T26 ^ M6
+    M9 = T20 & T17
+    M10 = M9 ^ M6
+    M11 = T1 & T15
+    M12 = T4 & T27
+    M13 = M12 ^ M11
+    M14 = T2 & T10
+    M15 = M14 ^ M11
+    M16 = M3 ^ M2
+    M17 = M5 ^ T24
+    M18 = M8 ^ M7
+    M19 = M10 ^ M15
+    M20 = M16 ^ M13
+    M21 = M17 ^ M15
+    M22 = M18 ^ M13
+    M23 = M19 ^ T25
+    M24 = M22 ^ M23
+    M25 = M22 & M20
+    M26 = M21 ^ M25
+    M27 = M20 ^ M21
+    M28 = M23 ^ M25
+    M29 = M28 & M27
+    M30 = M26 & M24
+    M31 = M20 & M23
+    M32 = M27 & M31
+    M33 = M27 ^ M25
+    M34 = M21 & M22
+    M35 = M24 & M34
+    M36 = M24 ^ M25
+    M37 = M21 ^ M29
+    M38 = M32 ^ M33
+    M39 = M23 ^ M30
+    M40 = M35 ^ M36
+    M41 = M38 ^ M40
+    M42 = M37 ^ M39
+    M43 = M37 ^ M38
+    M44 = M39 ^ M40
+    M45 = M42 ^ M41
+    M46 = M44 & T6
+    M47 = M40 & T8
+    M48 = M39 & U7
+    M49 = M43 & T16
+    M50 = M38 & T9
+    M51 = M37 & T17
+    M52 = M42 & T15
+    M53 = M45 & T27
+    M54 = M41 & T10
+    M55 = M44 & T13
+    M56 = M40 & T23
+    M57 = M39 & T19
+    M58 = M43 & T3
+    M59 = M38 & T22
+    M60 = M37 & T20
+    M61 = M42 & T1
+    M62 = M45 & T4
+    M63 = M41 & T2
+
+    L0 = M61 ^ M62
+    L1 = M50 ^ M56
+    L2 = M46 ^ M48
+    L3 = M47 ^ M55
+    L4 = M54 ^ M58
+    L5 = M49 ^ M61
+    L6 = M62 ^ L5
+    L7 = M46 ^ L3
+    L8 = M51 ^ M59
+    L9 = M52 ^ M53
+    L10 = M53 ^ L4
+    L11 = M60 ^ L2
+    L12 = M48 ^ M51
+    L13 = M50 ^ L0
+    L14 = M52 ^ M61
+    L15 = M55 ^ L1
+    L16 = M56 ^ L0
+    L17 = M57 ^ L1
+    L18 = M58 ^ L8
+    L19 = M63 ^ L4
+    L20 = L0 ^ L1
+    L21 = L1 ^ L7
+    L22 = L3 ^ L12
+    L23 = L18 ^ L2
+    L24 = L15 ^ L9
+    L25 = L6 ^ L10
+    L26 = L7 ^ L9
+    L27 = L8 ^ L10
+    L28 = L11 ^ L14
+    L29 = L11 ^ L17
+
+    return [L6 ^ L23 ^ ones, L13 ^ L27 ^ ones, L25 ^ L29, L20 ^ L22,
+            L6 ^ L21, L19 ^ L28 ^ ones, L16 ^ L26 ^ ones, L6 ^ L24]
+
+
+def invAffine(a, ones):
+    """Inverts the affine transform of the S-box on 8 bit slices"""
+    return [a[2] ^ a[5] ^ a[7] ^ ones, a[3] ^ a[6] ^ a[0],
+            a[4] ^ a[7] ^ a[1] ^ ones, a[5] ^ a[0] ^ a[2],
+            a[6] ^ a[1] ^ a[3], a[7] ^ a[2] ^ a[4],
+            a[0] ^ a[3] ^ a[5], a[1] ^ a[4] ^ a[6]]
+
+
+def invSbox(a, ones):
+    """Computes InvSubBytes on 8 bit slices. The inverse S-box is the
+       S-box with the affine transform undone on both sides."""
+    return invAffine(sbox(invAffine(a, ones), ones), ones)
+
+
+def xtime(a):
+    """Multiplies a byte held as 8 bit slices by x in GF(2^8)"""
+    h = a[7]
+    return [h, a[0] ^ h, a[1], a[2] ^ h, a[3] ^ h, a[4], a[5], a[6]]
+
+
+def subShift(s, shift, box, ones):
+    """Applies SubBytes (or InvSubBytes) and ShiftRows together, returning
+       a new list of 16 bytes of bit slices"""
+    return [box(s[q], ones) for q in shift]
+
+
+def mixColumns(s):
+    """Applies MixColumns to a list of 16 bytes of bit slices in place"""
+    for c in range(0, 16, 4):
+        a = s[c:c + 4]
+        t = [a[0][b] ^ a[1][b] ^ a[2][b] ^ a[3][b] for b in range(8)]
+        for r in range(4):
+            ar = a[r]
+            an = a[(r + 1) % 4]
+            x = xtime([ar[b] ^ an[b] for b in range(8)])
+            s[c + r] = [ar[b] ^ t[b] ^ x[b] for b in range(8)]
+
+
+def invMixColumns(s):
+    """Applies InvMixColumns to a list of 16 bytes of bit slices in place,
+       by multiplying each column by 4x^2 + 5 and then running MixColumns"""
+    for c in range(0, 16, 4):
+        a0, a1, a2, a3 = s[c:c + 4]
+        u = xtime(xtime([a0[b] ^ a2[b] for b in range(8)]))
+        v = xtime(xtime([a1[b] ^ a3[b] for b in range(8)]))
+        s[c] = [a0[b] ^ u[b] for b in range(8)]
+        s[c + 1] = [a1[b] ^ v[b] for b in range(8)]
+        s[c + 2] = [a2[b] ^ u[b] for b in range(8)]
+        s[c + 3] = [a3[b] ^ v[b] for b in range(8)]
+    mixColumns(s)
+
+
+def roundKeyBits(rk, numRounds):
+    """Converts a key schedule of 32-bit words into one list per round of
+       the 128 bits of that round key, 0 or 1, in slice order: bit b of
+       byte p is entry 8p + b"""
+    rounds = []
+    for r in range(numRounds + 1):
+        bits = []
+        for p in range(16):
+            byte = (rk[4 * r + p // 4] >> (24 - 8 * (p % 4))) & 0xFF
+            bits.extend((byte >> b) & 1 for b in range(8))
+        rounds.append(bits)
+    return rounds
+
+
+def addRoundKey(s, keyBits, ones):
+    """XORs a round key into a list of 16 bytes of bit slices in place.
+       Every slice is XOR'd with a mask of all zeros or all ones, so the
+       same operations are done whatever the key."""
+    for p in range(16):
+        byte = s[p]
+        for b in range(8):
+            byte[b] ^= -keyBits[8 * p + b] & ones
+
+
+def addRoundKeySlices(s, roundKey, ones):
+    """XORs a round key held as 16 bytes of bit slices, so that every block
+       has its own key, into a list of 16 bytes of bit slices in place"""
+    for p in range(16):
+        a = s[p]
+        k = roundKey[p]
+        s[p] = [a[b] ^ k[b] for b in range(8)]
+
+
+def encryptSlices(s, keys, numRounds, ones, addKey=addRoundKey):
+    """Encrypts the blocks held in a list of 16 bytes of bit slices. keys
+       holds a round key per round in the form addKey() takes."""
+    addKey(s, keys[0], ones)
+    for r in range(1, numRounds):
+        s = subShift(s, SHIFT_ROWS, sbox, ones)
+        mixColumns(s)
+        addKey(s, keys[r], ones)
+    s = subShift(s, SHIFT_ROWS, sbox, ones)
+    addKey(s, keys[numRounds], ones)
+    return s
+
+
+def decryptSlices(s, keys, numRounds, ones, addKey=addRoundKey):
+    """Decrypts the blocks held in a list of 16 bytes of bit slices"""
+    addKey(s, keys[numRounds], ones)
+    for r in range(numRounds - 1, 0, -1):
+        s = subShift(s, INV_SHIFT_ROWS, invSbox, ones)
+        addKey(s, keys[r], ones)
+        invMixColumns(s)
+    s = subShift(s, INV_SHIFT_ROWS, invSbox, ones)
+    addKey(s, keys[0], ones)
+    return s
+
+
+def g(word, i, ones):
+    """The g function of the key schedule on a word of 4 bytes of bit
+       slices: rotate, substitute, and XOR Rcon[i] into the first byte"""
+    word = [sbox(word[1], ones), sbox(word[2], ones), sbox(word[3], ones),
+            sbox(word[0], ones)]
+    first = word[0]
+    word[0] = [first[b] ^ ones if (RC[i] >> b) & 1 else first[b]
+               for b in range(8)]
+    return word
+
+
+def xorWords(a, b):
+    """XORs two words of 4 bytes of bit slices"""
+    return [[x[i] ^ y[i] for i in range(8)] for x, y in zip(a, b)]
+
+
+def nextRoundKey(prevKey, i, ones):
+    """Returns the next 4 or 8 words of the key schedule after prevKey, for
+       every key in the batch at once"""
+    nk = len(prevKey)
+    words = [xorWords(g(prevKey[-1], i, ones), prevKey[0])]
+    for j in range(1, nk):
+        temp = words[-1]
+        if nk == 8 and j == 4:
+            temp = [sbox(x, ones) for x in temp]
+        words.append(xorWords(temp, prevKey[j]))
+    return words
+
+
+def expandKeys(key, numRounds, ones):
+    """Expands a batch of keys, each held as 16 or 32 bytes of bit slices,
+       into numRounds + 1 round keys of 16 bytes of bit slices"""
+    nk = len(key) // 4
+    words = [key[4 * j:4 * j + 4] for j in range(nk)]
+    prevKey = words
+    i = 1
+    while len(words) < 4 * (numRounds + 1):
+        prevKey = nextRoundKey(prevKey, i, ones)
+        words.extend(prevKey)
+        i += 1
+    return [[byte for word in words[4 * r:4 * r + 4] for byte in word]
+            for r in range(numRounds + 1)]
+
+
+def pack(data, numBlocks, order, width=16):
+    """Slices numBlocks blocks of data, a multiple of 8, into 16 bytes of 8
+       bit slices each. Bit j of a slice belongs to block j. order gives the
+       offset within each input block of each state byte. Blocks of other
+       widths, such as 32-byte keys, are sliced into width bytes."""
+    packTable = tables.get("PACK")
+    s = []
+    for p in range(width):
+        column = data[order[p]::width]
+        byte = []
+        for b in range(8):
+            bits = column.translate(packTable[b])
+            x = 0
+            for k in range(8):
+                x |= int.from_bytes(bits[k::8], "little") << k
+            byte.append(x)
+        s.append(byte)
+    return s
+
+
+def unpack(s, numBlocks, order):
+    """Reverses pack(), returning the blocks as bytes"""
+    unpackTable = tables.get("UNPACK")
+    size = numBlocks // 8
+    out = bytearray(numBlocks * 16)
+    for p in range(16):
+        slices = [x.to_bytes(size, "little") for x in s[p]]
+        for k in range(8):
+            x = 0
+            for b in range(8):
+                x |= int.from_bytes(slices[b].translate(unpackTable[k][b]),
+                                    "little")
+            out[order[p] + 16 * k::128] = x.to_bytes(size, "little")
+    return out
+
+
+def cipherBlocks(data, keyBits, numRounds, decrypt, transpose=False):
+    """Encrypts or decrypts whole 16-byte blocks of data with round keys
+       from roundKeyBits(), a batch of blocks at a time. If transpose is True
+       the plaintext side of each block is row by row, as in the T-table
+       engine's transpose mode."""
+    order = TRANSPOSE if transpose else IDENTITY
+    inOrder, outOrder = (IDENTITY, order) if decrypt else (order, IDENTITY)
+    cipher = decryptSlices if decrypt else encryptSlices
+    numBlocks = len(data) // 16
+    out = bytearray()
+    for start in range(0, numBlocks, BATCH_BLOCKS):
+        batch = bytes(data[start * 16:(start + BATCH_BLOCKS) * 16])
+        n = len(batch) // 16
+        padded = -n % 8
+        if padded:
+            batch += bytes(16 * padded)
+        ones = (1 << (n + padded)) - 1
+        s = cipher(pack(batch, n + padded, inOrder), keyBits, numRounds,
+                   ones)
+        out += unpack(s, n + padded, outOrder)[:n * 16]
+    return out
+
+
+def cipherBlocksKeyed(data, keys, keyLength, decrypt):
+    """Encrypts or decrypts whole 16-byte blocks of data, each with its own
+       key of keyLength bytes taken in turn from keys, a batch of blocks at
+       a time. The keys are expanded for the whole batch at once. Blocks
+       are in the FIPS-197 layout."""
+    numRounds = 10 if keyLength == 16 else 14
+    keyOrder = list(range(keyLength))
+    cipher = decryptSlices if decrypt else encryptSlices
+    numBlocks = len(data) // 16
+    out = bytearray()
+    for start in range(0, numBlocks, BATCH_BLOCKS):
+        batch = bytes(data[start * 16:(start + BATCH_BLOCKS) * 16])
+        batchKeys = bytes(keys[start * keyLength:
+                               (start + BATCH_BLOCKS) * keyLength])
+        n = len(batch) // 16
+        padded = -n % 8
+        if padded:
+            batch += bytes(16 * padded)
+            batchKeys += bytes(keyLength * padded)
+        ones = (1 << (n + padded)) - 1
+        roundKeys = expandKeys(pack(batchKeys, n + padded, keyOrder,
+                                    keyLength), numRounds, ones)
+        s = cipher(pack(batch, n + padded, IDENTITY), roundKeys, numRounds,
+                   ones, addRoundKeySlices)
+        out += unpack(s, n + padded, IDENTITY)[:n * 16]
+    return out
@@ -0,0 +1,204 @@
+import os
+import struct
+import modes
+import ttable
+
+# Header: magic, version, cipher mode, reserved, chunk size, then the nonce
+# (CTR, zero padded) or base IV (CBC)
+HEADER = struct.Struct(">4sBBHI16s")
+MAGIC = b"AESC"
+VERSION = 1
+
+MODE_CTR = 1
+MODE_CBC = 2
+
+
+def newHeader(cipherMode, chunkSize):
+    """Returns a header for a new container with a random nonce or IV. The
+       chunk size is rounded down to whole blocks."""
+    chunkSize = max(16, chunkSize - chunkSize % 16)
+    if cipherMode == MODE_CTR:
+        iv = modes.newNonce() + bytes(16 - modes.NONCE_SIZE)
+    else:
+        iv = modes.newIV()
+    return HEADER.pack(MAGIC, VERSION, cipherMode, 0, chunkSize, iv)
+
+
+def parseHeader(header):
+    """Returns the cipher mode, chunk size and nonce or IV from a header,
+       raising ValueError if it is not a container header"""
+    if len(header) != HEADER.size:
+        raise ValueError("file is too short to be a container")
+    magic, version, cipherMode, _, chunkSize, iv = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a container file")
+    if cipherMode not in (MODE_CTR, MODE_CBC) or chunkSize % 16 or \
+            chunkSize == 0:
+        raise ValueError("unsupported container header")
+    if cipherMode == MODE_CTR:
+        iv = iv[:modes.NONCE_SIZE]
+    return cipherMode, chunkSize, iv
+
+
+def chunkIV(rk, numRounds, iv, index):
+    """Returns the IV CBC chunk index is chained from: the base IV with the
+       index XOR'd into its last 8 bytes, encrypted"""
+    a, b, c, d = struct.unpack(">4I", iv)
+    c ^= (index >> 32) & 0xFFFFFFFF
+    d ^= index & 0xFFFFFFFF
+    return struct.pack(">4I", *ttable.encryptBlock(a, b, c, d, rk,
+                                                   numRounds))
+
+
+def fixedChunks(chunks, size):
+    """Regroups a stream of chunks into chunks of exactly size bytes, and a
+       shorter final chunk if anything is left over"""
+    pending = b""
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        end = len(chunk) - len(chunk) % size
+        for off in range(0, end, size):
+            yield chunk[off:off + size]
+        pending = chunk[end:]
+    if pending:
+        yield pending
+
+
+def cbcEncryptTask(data, iv):
+    """Encrypts one container chunk in a worker process"""
+    rk, numRounds = modes.workerKey
+    return modes.cbcEncrypt(data, rk, numRounds,
+                            struct.unpack(">4I", iv))[0]
+
+
+def encryptChunks(chunks, rk, numRounds, header, workers=None):
+    """Encrypts a stream of plaintext chunks into the body of a container
+       with the given header. CBC chunks are independent of each other, so
+       they are encrypted in parallel."""
+    cipherMode, chunkSize, iv = parseHeader(header)
+    if cipherMode == MODE_CTR:
+        return modes.ctrChunks(chunks, rk, numRounds, iv, workers)
+
+    def tasks():
+        # The whole stream is padded and then cut into chunks, so only the
+        # last chunk is short
+        index = 0
+        pending = b""
+        for chunk in fixedChunks(chunks, chunkSize):
+            if pending:
+                yield pending, chunkIV(rk, numRounds, iv, index)
+                index += 1
+            pending = chunk
+        if len(pending) == chunkSize:
+            yield pending, chunkIV(rk, numRounds, iv, index)
+            pending = b""
+            index += 1
+        yield modes.pkcs7Pad(pending), chunkIV(rk, numRounds, iv, index)
+
+    return modes.mapInOrder(cbcEncryptTask, tasks(), workers,
+                            (rk, numRounds))
+
+
+def decryptChunks(chunks, rk, numRounds, header, workers=None):
+    """Decrypts a stream of chunks holding the body of a container with the
+       given header. The decryption key schedule, and with it the TD
+       tables, is only derived for a CBC container."""
+    cipherMode, chunkSize, iv = parseHeader(header)
+    if cipherMode == MODE_CTR:
+        return modes.ctrChunks(chunks, rk, numRounds, iv, workers)
+    drk = ttable.inverseWordSchedule(rk, numRounds)
+
+    def tasks():
+        for index, chunk in enumerate(fixedChunks(chunks, chunkSize)):
+            if len(chunk) % 16:
+                raise ValueError("ciphertext is not a whole number of blocks")
+            yield chunk, chunkIV(rk, numRounds, iv, index)
+
+    plain = modes.mapInOrder(modes.cbcTask, tasks(), workers,
+                             (drk, numRounds))
+    return modes.unpadChunks(plain)
+
+
+def readAt(f, offset, size):
+    """Reads exactly size bytes from offset in a file"""
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError("container is truncated")
+    return data
+
+
+def cbcBlocks(f, rk, drk, numRounds, chunkSize, iv, first, last):
+    """Decrypts blocks first to last of a CBC container body, which must
+       all be in the same chunk"""
+    data = readAt(f, HEADER.size + first * 16, (last - first + 1) * 16)
+    if first % (chunkSize // 16):
+        prev = readAt(f, HEADER.size + (first - 1) * 16, 16)
+    else:
+        prev = chunkIV(rk, numRounds, iv, first * 16 // chunkSize)
+    return modes.cbcDecrypt(data, prev, drk, numRounds)
+
+
+def plainLength(f, rk, drk, numRounds, header):
+    """Returns the length of the plaintext in a container file by looking
+       at its size and, for CBC, the padding in its last block. drk is only
+       used for CBC, and may be None for CTR."""
+    cipherMode, chunkSize, iv = parseHeader(header)
+    size = os.fstat(f.fileno()).st_size - HEADER.size
+    if cipherMode == MODE_CTR:
+        return size
+    if size <= 0 or size % 16:
+        raise ValueError("ciphertext is not a whole number of blocks")
+    last = size // 16 - 1
+    block = cbcBlocks(f, rk, drk, numRounds, chunkSize, iv, last, last)
+    return size - 16 + len(modes.pkcs7Unpad(block))
+
+
+def decryptRange(f, rk, numRounds, start, end=None):
+    """Returns bytes start to end (exclusive) of the plaintext in a
+       container file, reading and decrypting only the blocks that cover
+       them. end defaults to, and is clipped to, the end of the
+       plaintext."""
+    header = readAt(f, 0, HEADER.size)
+    cipherMode, chunkSize, iv = parseHeader(header)
+    drk = None
+    if cipherMode == MODE_CBC:
+        drk = ttable.inverseWordSchedule(rk, numRounds)
+    length = plainLength(f, rk, drk, numRounds, header)
+    end = length if end is None else min(end, length)
+    if start >= end:
+        return b""
+
+    first = start // 16
+    last = (end - 1) // 16
+    if cipherMode == MODE_CTR:
+        data = readAt(f, HEADER.size + first * 16,
+                      min(last * 16 + 16, length) - first * 16)
+        out = modes.ctrXor(data, iv, first, rk, numRounds)
+    else:
+        # Chaining starts again at every chunk, so decrypt chunk by chunk
+        blocksPerChunk = chunkSize // 16
+        parts = []
+        block = first
+        while block <= last:
+            stop = min(last, (block // blocksPerChunk + 1) *
+                       blocksPerChunk - 1)
+            parts.append(cbcBlocks(f, rk, drk, numRounds, chunkSize, iv,
+                                   block, stop))
+            block = stop + 1
+        out = b"".join(parts)
+    return out[start - first * 16:end - first * 16]
+
+
+def parseRange(text):
+    """Parses START:END into a (start, end) tuple. Either side may be left
+       out; end is None when it is."""
+    start, sep, end = text.partition(":")
+    if not sep:
+        raise ValueError("range must be START:END")
+    start = int(start) if start else 0
+    end = int(end) if end else None
+    if start < 0 or (end is not None and end < start):
+        raise ValueError("invalid range %s" % text)
+    return start, end
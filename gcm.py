@@ -0,0 +1,226 @@
+import hmac
+import os
+import modes
+import tables
+import ttable
+
+IV_SIZE = 12
+TAG_SIZE = 16
+
+# GHASH works in GF(2^128) with the bits of each byte reversed: a block read
+# as a big-endian int holds the coefficient of x^0 in its top bit, so
+# multiplying by x is a right shift, reduced with R when a bit falls off
+R = 0xE1 << 120
+
+
+def mulX(v):
+    """Multiplies a field element by x"""
+    return (v >> 1) ^ R if v & 1 else v >> 1
+
+
+def reductionTable():
+    """Returns the table for Shoup's 8-bit method that folds the byte
+       shifted out by a multiplication by x^8 back into the element. Each
+       128-bit entry is given as its high and low 64 bits."""
+    table = []
+    for b in range(256):
+        v = b
+        for _ in range(8):
+            v = mulX(v)
+        table += [v >> 64, v & 0xFFFFFFFFFFFFFFFF]
+    return table
+
+
+def joinHalves(values):
+    """Joins the 64-bit halves of the reduction table into 128-bit ints"""
+    return [(values[i] << 64) | values[i + 1]
+            for i in range(0, len(values), 2)]
+
+
+# SHA-256 of each cached table, checked whenever it is loaded or built
+R8_DIGEST = (
+    "0adf401672a51ef72c048dc75a114d45a4776e3202c073d0bfca8744b86f5b47")
+
+# The reduction table does not depend on the key, so it is cached; the
+# multiplication tables are built per key and only kept in memory
+tables.register("R8", "Q", reductionTable, joinHalves, R8_DIGEST)
+
+
+def multiplyTable(h):
+    """Returns Shoup's 8-bit table for the hash subkey h: entry b is the
+       byte b, placed as the first byte of a block, times h"""
+    # Bit 7 of the first byte is x^0, bit 6 is x^1, and so on
+    powers = [h]
+    for _ in range(7):
+        powers.append(mulX(powers[-1]))
+    table = [0] * 256
+    for b in range(1, 256):
+        v = 0
+        for i in range(8):
+            if b & (0x80 >> i):
+                v ^= powers[i]
+        table[b] = v
+    return table
+
+
+def ghash(table, y, data):
+    """Folds data into the GHASH state y and returns the new state. A final
+       partial block is padded with zeros."""
+    r8 = tables.get("R8")
+    for off in range(0, len(data), 16):
+        x = y ^ int.from_bytes(data[off:off + 16].ljust(16, b"\0"), "big")
+        # Horner's rule over the bytes of x, last byte first
+        y = 0
+        for b in x.to_bytes(16, "little"):
+            y = (y >> 8) ^ r8[y & 0xFF] ^ table[b]
+    return y
+
+
+def hashSubkey(rk, numRounds):
+    """Returns the hash subkey H, the encryption of the zero block, as an
+       int"""
+    h0, h1, h2, h3 = ttable.encryptBlock(0, 0, 0, 0, rk, numRounds)
+    return (h0 << 96) | (h1 << 64) | (h2 << 32) | h3
+
+
+def initialCounter(table, iv):
+    """Returns the pre-counter block J0 for an IV as an int"""
+    if len(iv) == IV_SIZE:
+        return (int.from_bytes(iv, "big") << 32) | 1
+    y = ghash(table, 0, iv)
+    return ghash(table, y, (len(iv) * 8).to_bytes(16, "big"))
+
+
+def gctr(data, j0, offset, rk, numRounds):
+    """XORs data with the GCM keystream starting offset blocks after J0.
+       Only the low 32 bits of the counter are incremented, so the
+       keystream is made in two parts when they wrap around."""
+    nonce = (j0 >> 64).to_bytes(8, "big")
+    high = j0 & 0xFFFFFFFF00000000
+    low = ((j0 & 0xFFFFFFFF) + offset) & 0xFFFFFFFF
+    numBlocks = (len(data) + 15) // 16
+    if low + numBlocks <= 1 << 32:
+        return modes.ctrXor(data, nonce, high | low, rk, numRounds)
+    split = ((1 << 32) - low) * 16
+    return (modes.ctrXor(data[:split], nonce, high | low, rk, numRounds) +
+            modes.ctrXor(data[split:], nonce, high, rk, numRounds))
+
+
+def newIV():
+    """Returns a random 96-bit IV for GCM"""
+    return os.urandom(IV_SIZE)
+
+
+class GCM:
+    """State of one GCM encryption or decryption: the GHASH tables for the
+       key, the counter and the running hash of the AAD and ciphertext.
+       xor(), hash(), encrypt() and decrypt() must be given whole blocks
+       until the last call."""
+
+    def __init__(self, rk, numRounds, iv, aad=b""):
+        self.rk = rk
+        self.numRounds = numRounds
+        self.table = multiplyTable(hashSubkey(rk, numRounds))
+        self.j0 = initialCounter(self.table, iv)
+        self.y = ghash(self.table, 0, aad)
+        self.aadLength = len(aad)
+        self.offset = 0
+        self.length = 0
+
+    def xor(self, data):
+        """Encrypts or decrypts the next data with the keystream"""
+        out = gctr(data, self.j0, 1 + self.offset // 16, self.rk,
+                   self.numRounds)
+        self.offset += len(data)
+        return out
+
+    def hash(self, ciphertext):
+        """Folds the next ciphertext into the hash"""
+        self.y = ghash(self.table, self.y, ciphertext)
+        self.length += len(ciphertext)
+
+    def encrypt(self, data):
+        """Encrypts the next data and hashes the ciphertext"""
+        out = self.xor(data)
+        self.hash(out)
+        return out
+
+    def decrypt(self, data):
+        """Hashes the next ciphertext and decrypts it"""
+        self.hash(data)
+        return self.xor(data)
+
+    def tag(self):
+        """Returns the authentication tag for everything hashed so far"""
+        lengths = ((self.aadLength * 8) << 64) | (self.length * 8)
+        s = ghash(self.table, self.y, lengths.to_bytes(16, "big"))
+        mask = gctr(bytes(TAG_SIZE), self.j0, 0, self.rk, self.numRounds)
+        return (s ^ int.from_bytes(mask, "big")).to_bytes(TAG_SIZE, "big")
+
+    def verify(self, tag):
+        """Raises ValueError unless tag matches, in constant time"""
+        if not hmac.compare_digest(self.tag(), bytes(tag)):
+            raise ValueError("authentication failed")
+
+
+def splitTag(chunks, tag):
+    """Yields a stream of chunks without its last TAG_SIZE bytes, which are
+       appended to the list tag at the end"""
+    held = b""
+    for chunk in chunks:
+        if held:
+            chunk = held + chunk
+        held = chunk[-TAG_SIZE:]
+        if len(chunk) > TAG_SIZE:
+            yield chunk[:-TAG_SIZE]
+    if len(held) < TAG_SIZE:
+        raise ValueError("ciphertext is shorter than the tag")
+    tag.append(held)
+
+
+def encryptChunks(chunks, rk, numRounds, iv, aad=b""):
+    """Encrypts and authenticates a stream of chunks in one pass, yielding
+       the ciphertext and then the tag"""
+    state = GCM(rk, numRounds, iv, aad)
+    for chunk in modes.wholeBlocks(chunks):
+        yield state.encrypt(chunk)
+    yield state.tag()
+
+
+def verifyChunks(chunks, rk, numRounds, iv, aad=b""):
+    """Checks the tag at the end of a stream of ciphertext chunks without
+       decrypting anything. Raises ValueError if it does not match."""
+    state = GCM(rk, numRounds, iv, aad)
+    tag = []
+    for chunk in modes.wholeBlocks(splitTag(chunks, tag)):
+        state.hash(chunk)
+    state.verify(tag[0])
+
+
+def decryptChunksUnverified(chunks, rk, numRounds, iv, aad=b"",
+                            verify=True):
+    """UNVERIFIED: yields plaintext from a stream of ciphertext chunks before
+       the tag at the end of the stream has been checked. Only use this when
+       the caller can discard everything it was given if ValueError is
+       raised at the end, or after verifyChunks() has already passed on the
+       same data, in which case verify can be False to skip hashing it
+       twice."""
+    state = GCM(rk, numRounds, iv, aad)
+    tag = []
+    for chunk in modes.wholeBlocks(splitTag(chunks, tag)):
+        yield state.decrypt(chunk) if verify else state.xor(chunk)
+    if verify:
+        state.verify(tag[0])
+
+
+def encrypt(data, rk, numRounds, iv, aad=b""):
+    """Encrypts data, returning the ciphertext followed by the tag"""
+    return b"".join(encryptChunks([data], rk, numRounds, iv, aad))
+
+
+def decrypt(data, rk, numRounds, iv, aad=b""):
+    """Checks the tag at the end of data and only then decrypts it. Raises
+       ValueError if the tag does not match."""
+    verifyChunks([data], rk, numRounds, iv, aad)
+    return b"".join(decryptChunksUnverified([data], rk, numRounds, iv, aad,
+                                            verify=False))
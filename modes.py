@@ -0,0 +1,244 @@
+import os
+import struct
+from collections import deque
+from itertools import chain, islice
+from concurrent.futures import ProcessPoolExecutor
+import ttable
+import bitsliced
+
+NONCE_SIZE = 8
+IV_SIZE = 16
+COUNTER_MASK = (1 << 64) - 1
+
+# Key schedule held by each worker process, set once by initWorker()
+workerKey = None
+
+
+def xorBytes(a, b):
+    """XORs two byte strings, truncating b to the length of a. Raises
+       ValueError if b is shorter than a."""
+    n = len(a)
+    if len(b) < n:
+        raise ValueError("not enough bytes to XOR with")
+    return (int.from_bytes(a, "big") ^
+            int.from_bytes(b[:n], "big")).to_bytes(n, "big")
+
+
+def newNonce():
+    """Returns a random nonce for CTR mode"""
+    return os.urandom(NONCE_SIZE)
+
+
+def newIV():
+    """Returns a random initialization vector for CBC mode"""
+    return os.urandom(IV_SIZE)
+
+
+def pkcs7Pad(data):
+    """Pads data shorter than a block to a whole block, CMS style. Always
+       adds at least one byte, so a full block of padding is added to empty
+       data."""
+    n = 16 - len(data) % 16
+    return data + bytes([n]) * n
+
+
+def pkcs7Unpad(block):
+    """Strips CMS padding from the final block, raising ValueError if the
+       padding is malformed."""
+    if len(block) != 16:
+        raise ValueError("ciphertext is not a whole number of blocks")
+    n = block[-1]
+    if n < 1 or n > 16 or block[-n:] != bytes([n]) * n:
+        raise ValueError("invalid padding")
+    return block[:-n]
+
+
+def ctrKeystream(nonce, counter, numBlocks, rk, numRounds):
+    """Returns numBlocks blocks of keystream, starting at the given counter.
+       Each counter block is the 8-byte nonce followed by the 64-bit block
+       counter, encrypted with the bitsliced engine, or the T-table engine
+       when there are too few blocks for bitslicing to pay off."""
+    if numBlocks >= bitsliced.MIN_BLOCKS:
+        blocks = b"".join(nonce + ((counter + i) & COUNTER_MASK).to_bytes(
+            8, "big") for i in range(numBlocks))
+        return bitsliced.cipherBlocks(blocks,
+                                      bitsliced.roundKeyBits(rk, numRounds),
+                                      numRounds, False)
+    n0, n1 = struct.unpack(">2I", nonce)
+    out = bytearray(numBlocks * 16)
+    for i in range(numBlocks):
+        c = counter + i
+        struct.pack_into(">4I", out, i * 16,
+                         *ttable.encryptBlock(n0, n1, (c >> 32) & 0xFFFFFFFF,
+                                              c & 0xFFFFFFFF, rk, numRounds))
+    return out
+
+
+def checkNonce(nonce):
+    """Raises ValueError unless nonce is NONCE_SIZE bytes long"""
+    if len(nonce) != NONCE_SIZE:
+        raise ValueError("nonce must be %d bytes" % NONCE_SIZE)
+
+
+def ctrXor(data, nonce, counter, rk, numRounds):
+    """Encrypts or decrypts data in CTR mode, with data starting at the block
+       with the given counter. Raises ValueError unless the nonce is
+       NONCE_SIZE bytes long."""
+    checkNonce(nonce)
+    numBlocks = (len(data) + 15) // 16
+    return xorBytes(data, ctrKeystream(nonce, counter, numBlocks, rk,
+                                       numRounds))
+
+
+def cbcEncrypt(data, rk, numRounds, prev):
+    """Encrypts whole blocks of data in CBC mode, chaining from prev, the
+       previous ciphertext block as four 32-bit words. Returns the ciphertext
+       and its last block as four words."""
+    out = bytearray(len(data))
+    p0, p1, p2, p3 = prev
+    for off in range(0, len(data), 16):
+        a, b, c, d = struct.unpack_from(">4I", data, off)
+        p0, p1, p2, p3 = ttable.encryptBlock(a ^ p0, b ^ p1, c ^ p2, d ^ p3,
+                                             rk, numRounds)
+        struct.pack_into(">4I", out, off, p0, p1, p2, p3)
+    return out, (p0, p1, p2, p3)
+
+
+def cbcDecrypt(data, prev, drk, numRounds):
+    """Decrypts whole blocks of data in CBC mode using an inverse key
+       schedule. prev is the ciphertext block before data (the IV for the
+       first block). Every block is decrypted on its own and the result is
+       XOR'd with the preceding ciphertext at the end."""
+    out = bytearray(len(data))
+    for off in range(0, len(data), 16):
+        struct.pack_into(">4I", out, off,
+                         *ttable.decryptBlock(*struct.unpack_from(">4I", data,
+                                                                  off),
+                                              drk, numRounds))
+    return xorBytes(out, prev + data[:-16])
+
+
+def cbcEncryptChunks(chunks, rk, numRounds, iv):
+    """Encrypts a stream of chunks in CBC mode, yielding ciphertext chunks.
+       Padding is added to the final partial block only."""
+    prev = struct.unpack(">4I", iv)
+    pending = b""
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        end = len(chunk) - len(chunk) % 16
+        pending = chunk[end:]
+        if end > 0:
+            out, prev = cbcEncrypt(chunk[:end] if end < len(chunk) else chunk,
+                                   rk, numRounds, prev)
+            yield out
+    out, prev = cbcEncrypt(pkcs7Pad(pending), rk, numRounds, prev)
+    yield out
+
+
+def cbcDecryptChunks(chunks, drk, numRounds, iv, workers=None):
+    """Decrypts a stream of chunks in CBC mode, yielding plaintext chunks.
+       Each chunk only needs the ciphertext block before it, so the chunks
+       are decrypted in parallel by a pool of worker processes. The padding
+       is checked and stripped from the final block."""
+    def tasks():
+        prev = iv
+        for chunk in wholeBlocks(chunks):
+            if len(chunk) % 16:
+                raise ValueError("ciphertext is not a whole number of blocks")
+            yield chunk, prev
+            prev = chunk[-16:]
+
+    plain = mapInOrder(cbcTask, tasks(), workers, (drk, numRounds))
+    return unpadChunks(plain)
+
+
+def unpadChunks(chunks):
+    """Holds back the final block of a stream of chunks and yields the
+       stream with the padding stripped from that block"""
+    tail = b""
+    for chunk in chunks:
+        if tail:
+            chunk = tail + chunk
+        tail = chunk[-16:]
+        if len(chunk) > 16:
+            yield chunk[:-16]
+    last = pkcs7Unpad(tail)
+    if last:
+        yield last
+
+
+def initWorker(rk, numRounds):
+    """Stores the key schedule in a worker process"""
+    global workerKey
+    workerKey = (rk, numRounds)
+
+
+def ctrTask(data, nonce, counter):
+    """Runs ctrXor() in a worker process with its stored key schedule"""
+    return ctrXor(data, nonce, counter, *workerKey)
+
+
+def cbcTask(data, prev):
+    """Runs cbcDecrypt() in a worker process with its stored key schedule"""
+    return cbcDecrypt(data, prev, *workerKey)
+
+
+def mapInOrder(task, args, workers, initargs):
+    """Yields task(*a) for each tuple a in args, in order. The calls are
+       spread over a pool of worker processes that each run
+       initWorker(*initargs) once, with a bounded number of calls in
+       flight. No more workers are started than there are calls, and with
+       one worker or a single call everything runs in this process. With no
+       workers given, one is started per CPU."""
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1")
+    workers = workers or os.cpu_count() or 1
+    args = iter(args)
+    first = list(islice(args, workers))
+    workers = min(workers, len(first))
+    if workers <= 1:
+        initWorker(*initargs)
+        for a in chain(first, args):
+            yield task(*a)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=initWorker,
+                             initargs=initargs) as pool:
+        pending = deque()
+        for a in chain(first, args):
+            pending.append(pool.submit(task, *a))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ctrChunks(chunks, rk, numRounds, nonce, workers=None):
+    """Encrypts or decrypts a stream of chunks in CTR mode, yielding output
+       chunks in order. Every chunk is given its own counter range, so the
+       chunks are spread over a pool of worker processes."""
+    checkNonce(nonce)
+
+    def tasks():
+        counter = 0
+        for chunk in wholeBlocks(chunks):
+            yield chunk, nonce, counter
+            counter += len(chunk) // 16
+
+    return mapInOrder(ctrTask, tasks(), workers, (rk, numRounds))
+
+
+def wholeBlocks(chunks):
+    """Regroups a stream of chunks so that every chunk but the last holds a
+       whole number of blocks"""
+    pending = b""
+    for chunk in chunks:
+        if pending:
+            chunk = pending + chunk
+        end = len(chunk) - len(chunk) % 16
+        pending = chunk[end:]
+        if end > 0:
+            yield chunk[:end] if end < len(chunk) else chunk
+    if pending:
+        yield pending
@@ -0,0 +1,97 @@
+import queue
+import threading
+
+# Number of chunks buffered between a background I/O thread and the cipher
+DEFAULT_DEPTH = 4
+
+# Marks the end of the chunks passed through a queue
+DONE = object()
+
+
+def boundedQueue(depth):
+    """Returns a queue holding up to depth items. A depth below 1 would make
+       queue.Queue unbounded, so it is rejected."""
+    if depth < 1:
+        raise ValueError("queue depth must be at least 1")
+    return queue.Queue(depth)
+
+
+def timedGet(q, stats, stage, gauge):
+    """Takes the next item from a queue. With stats, the queue depth is
+       sampled first and any time spent waiting is timed as a stall."""
+    if stats is None:
+        return q.get()
+    stats.sample(gauge, q.qsize())
+    with stats.stage(stage):
+        return q.get()
+
+
+def timedPut(q, item, stats, stage):
+    """Puts an item on a queue, timing any wait for space as a stall"""
+    if stats is None:
+        q.put(item)
+        return
+    with stats.stage(stage):
+        q.put(item)
+
+
+def prefetch(chunks, depth=DEFAULT_DEPTH, stats=None):
+    """Yields the given chunks while a background thread reads ahead, so
+       that reading the next chunk overlaps with ciphering this one.
+       Exceptions raised while reading are re-raised here. With stats, time
+       the cipher waits for input is timed as "readStall", time the reader
+       waits for the cipher as "readBlocked", and the number of chunks
+       waiting is sampled as "readQueue"."""
+    q = boundedQueue(depth)
+
+    def reader():
+        try:
+            for chunk in chunks:
+                timedPut(q, chunk, stats, "readBlocked")
+        except BaseException as e:
+            q.put(e)
+        q.put(DONE)
+
+    threading.Thread(target=reader, daemon=True).start()
+    while True:
+        chunk = timedGet(q, stats, "readStall", "readQueue")
+        if chunk is DONE:
+            return
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+
+
+def writeAll(outputFile, chunks, depth=DEFAULT_DEPTH, stats=None):
+    """Writes the given chunks to the output file from a background thread,
+       so that writing overlaps with ciphering the next chunk. Exceptions
+       raised while writing are re-raised here. With stats, time the cipher
+       waits for the writer is timed as "writeStall", time the writer waits
+       for the cipher as "writeIdle", and the number of chunks waiting is
+       sampled as "writeQueue"."""
+    q = boundedQueue(depth)
+    errors = []
+
+    def writer():
+        while True:
+            chunk = timedGet(q, stats, "writeIdle", "writeQueue")
+            if chunk is DONE:
+                return
+            if not errors:
+                try:
+                    outputFile.write(chunk)
+                except BaseException as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            timedPut(q, chunk, stats, "writeStall")
+    finally:
+        q.put(DONE)
+        thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,217 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+
+class Stats:
+    """Collects wall time, bytes and call counts for each stage of a run.
+       Stages can nest: time spent in an inner stage is not counted for the
+       stage around it on the same thread, so stage times add up to the time
+       spent on that thread."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.stages = OrderedDict()
+        self.gauges = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.originals = []
+
+    def stack(self):
+        """Returns the stack of active stages for the current thread"""
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def enter(self, name):
+        """Starts timing a stage, pausing the enclosing stage"""
+        stack = self.stack()
+        now = time.perf_counter()
+        if stack:
+            outer = stack[-1]
+            self.record(outer[0], now - outer[1])
+        stack.append([name, now])
+
+    def exit(self, numBytes=0):
+        """Stops timing the current stage and resumes the enclosing one"""
+        stack = self.stack()
+        now = time.perf_counter()
+        name, since = stack.pop()
+        self.record(name, now - since, numBytes, 1)
+        if stack:
+            stack[-1][1] = now
+
+    def record(self, name, seconds, numBytes=0, calls=0):
+        """Adds time, bytes and calls to a stage's totals"""
+        with self.lock:
+            totals = self.stages.get(name)
+            if totals is None:
+                totals = self.stages[name] = [0.0, 0, 0]
+            totals[0] += seconds
+            totals[1] += numBytes
+            totals[2] += calls
+
+    def sample(self, name, value):
+        """Adds a sample of a value such as a queue depth, whose mean and
+           maximum are reported"""
+        with self.lock:
+            totals = self.gauges.get(name)
+            if totals is None:
+                totals = self.gauges[name] = [0, 0, 0]
+            totals[0] += 1
+            totals[1] += value
+            totals[2] = max(totals[2], value)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that times the code inside it as a stage"""
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def chunks(self, name, chunks):
+        """Yields the given chunks, timing the work done to produce each one
+           as a stage and counting its bytes"""
+        it = iter(chunks)
+        while True:
+            self.enter(name)
+            try:
+                chunk = next(it)
+            except StopIteration:
+                self.exit()
+                return
+            except BaseException:
+                self.exit()
+                raise
+            self.exit(len(chunk))
+            yield chunk
+
+    def wrap(self, func, name):
+        """Returns func wrapped so that each call is timed as a stage"""
+        def timedFunc(*args, **kwargs):
+            self.enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.exit()
+        timedFunc.__name__ = func.__name__
+        timedFunc.__doc__ = func.__doc__
+        return timedFunc
+
+    def instrument(self, namespace, names, prefix="round/"):
+        """Replaces the named functions in a module namespace with timed
+           wrappers, so their call counts and cumulative time are recorded.
+           finish() puts the original functions back."""
+        for name in names:
+            self.originals.append((namespace, name, namespace[name]))
+            namespace[name] = self.wrap(namespace[name], prefix + name)
+
+    def finish(self):
+        """Stops the wall clock for the run and removes any wrappers added by
+           instrument()"""
+        self.elapsed = time.perf_counter() - self.start
+        while self.originals:
+            namespace, name, func = self.originals.pop()
+            namespace[name] = func
+
+    def report(self):
+        """Returns the collected statistics as a dict"""
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.perf_counter() - self.start
+        stages = OrderedDict()
+        with self.lock:
+            for name, (seconds, numBytes, calls) in self.stages.items():
+                stages[name] = {
+                    "seconds": seconds,
+                    "bytes": numBytes,
+                    "blocks": numBytes // 16,
+                    "calls": calls,
+                    "mbPerSecond": (numBytes / seconds / 1e6
+                                    if seconds > 0 else 0.0),
+                }
+            gauges = OrderedDict()
+            for name, (count, total, peak) in self.gauges.items():
+                gauges[name] = {"samples": count, "mean": total / count,
+                                "max": peak}
+        return {"elapsed": elapsed, "stages": stages, "gauges": gauges}
+
+    def summary(self):
+        """Returns the collected statistics as a human readable table"""
+        report = self.report()
+        lines = ["%-24s %10s %14s %10s %12s" % ("stage", "seconds", "bytes",
+                                                "calls", "MB/s")]
+        for name, s in report["stages"].items():
+            lines.append("%-24s %10.4f %14d %10d %12.3f" %
+                         (name, s["seconds"], s["bytes"], s["calls"],
+                          s["mbPerSecond"]))
+        lines.append("%-24s %10.4f" % ("total", report["elapsed"]))
+        if report["gauges"]:
+            lines.append("%-24s %10s %14s %10s" % ("gauge", "mean", "max",
+                                                   "samples"))
+            for name, g in report["gauges"].items():
+                lines.append("%-24s %10.2f %14d %10d" %
+                             (name, g["mean"], g["max"], g["samples"]))
+        return "\n".join(lines)
+
+    def toJson(self):
+        """Returns the collected statistics as JSON"""
+        return json.dumps(self.report(), indent=2)
+
+
+class TimedFile:
+    """Wraps a file object so that reads and writes are timed as stages"""
+
+    def __init__(self, stats, f, readStage="read", writeStage="write"):
+        self.stats = stats
+        self.f = f
+        self.readStage = readStage
+        self.writeStage = writeStage
+
+    def read(self, size=-1):
+        self.stats.enter(self.readStage)
+        data = b""
+        try:
+            data = self.f.read(size)
+        finally:
+            self.stats.exit(len(data))
+        return data
+
+    def write(self, data):
+        self.stats.enter(self.writeStage)
+        try:
+            return self.f.write(data)
+        finally:
+            self.stats.exit(len(data))
+
+    def close(self):
+        self.stats.enter(self.writeStage)
+        try:
+            self.f.close()
+        finally:
+            self.stats.exit()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def timedStage(stats, name):
+    """Returns a context manager timing a stage, or one that does nothing if
+       stats is None"""
+    return nullcontext() if stats is None else stats.stage(name)
+
+
+def timedChunks(stats, name, chunks):
+    """Times a stream of chunks as a stage if stats is not None"""
+    return chunks if stats is None else stats.chunks(name, chunks)
+
+
+def timedFile(stats, f):
+    """Times reads and writes on a file if stats is not None"""
+    return f if stats is None else TimedFile(stats, f)
@@ -0,0 +1,174 @@
+import array
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+# Bumped whenever the contents or layout of a cached table change, so that
+# cache files written by older versions are rebuilt
+VERSION = 1
+
+MAGIC = b"AEST"
+
+# Header: magic, version, byte order of the arrays, number of tables and
+# the CRC-32 of everything after the header
+HEADER = struct.Struct(">4sHcxII")
+BYTE_ORDER = sys.byteorder[0].encode()
+
+# Directory entry for each table: name, array typecode, and the offset and
+# length of its bytes in the file
+ENTRY = struct.Struct(">24sc3xII")
+
+# Path of the cache file. Setting AES_TABLE_CACHE to an empty string turns
+# the cache off, and tables are then built in memory every run.
+CACHE_PATH = os.environ.get("AES_TABLE_CACHE", os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "aes", "tables.bin"))
+
+# Name of each registered table to its (typecode, build, shape, digest)
+builders = {}
+
+# Tables built or loaded so far in this process
+loaded = {}
+
+# Name to (typecode, bytes) of each table in the cache file, read on first
+# use
+cached = None
+
+lock = threading.Lock()
+
+
+def register(name, typecode, build, shape=None, digest=None):
+    """Registers a table to be built the first time it is used. build()
+       returns the table's values as a flat sequence for an array of
+       typecode, and shape(), if given, turns that array into the form the
+       table is used in. digest is the SHA-256 of the table from
+       tableDigest(), in hex; a cached table is only used if it matches. A
+       table with a typecode of None is not cached: build() returns the
+       table itself."""
+    if typecode is not None and digest is None:
+        raise ValueError("cached table %s needs a digest" % name)
+    builders[name] = (typecode, build, shape, digest)
+
+
+def tableDigest(values):
+    """Returns the SHA-256 of an array of table values in hex, taken over
+       its big-endian bytes so that it is the same on every platform"""
+    if sys.byteorder == "little" and values.itemsize > 1:
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return hashlib.sha256(values.tobytes()).hexdigest()
+
+
+def get(name):
+    """Returns a table, loading it from the cache file or building it the
+       first time it is asked for in this process"""
+    table = loaded.get(name)
+    if table is None:
+        with lock:
+            table = loaded.get(name)
+            if table is None:
+                table = loaded[name] = load(name)
+    return table
+
+
+def load(name):
+    """Loads a table from the cache file, or builds it and adds it to the
+       file if it is not there"""
+    global cached
+    typecode, build, shape, digest = builders[name]
+    if typecode is None:
+        return build()
+    if cached is None:
+        cached = readCache(CACHE_PATH)
+
+    # The cache file can be written by anyone who can write the user's
+    # cache directory, so a cached table is only trusted if it has exactly
+    # the expected contents
+    values = array.array(typecode)
+    entry = cached.get(name)
+    try:
+        if entry is None or entry[0] != typecode:
+            raise ValueError("table %s is not cached" % name)
+        values.frombytes(entry[1])
+        if tableDigest(values) != digest:
+            raise ValueError("cached table %s is wrong" % name)
+    except ValueError:
+        values = array.array(typecode, build())
+        if tableDigest(values) != digest:
+            raise RuntimeError("table %s does not match its digest" % name)
+        cached[name] = (typecode, values.tobytes())
+        writeCache(CACHE_PATH, cached)
+    return values if shape is None else shape(values)
+
+
+def parseCache(data):
+    """Returns the tables in the contents of a cache file as a dict of name
+       to (typecode, bytes). Raises ValueError if the file was written by
+       another version or its checksum does not match."""
+    if len(data) < HEADER.size:
+        raise ValueError("table cache is truncated")
+    magic, version, order, count, crc = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or order != BYTE_ORDER:
+        raise ValueError("table cache is stale")
+    if zlib.crc32(data[HEADER.size:]) != crc:
+        raise ValueError("table cache is damaged")
+    tables = {}
+    for i in range(count):
+        name, typecode, offset, size = ENTRY.unpack_from(
+            data, HEADER.size + i * ENTRY.size)
+        tables[name.rstrip(b"\0").decode()] = (typecode.decode(),
+                                               data[offset:offset + size])
+    return tables
+
+
+def readCache(path):
+    """Maps the cache file and reads its tables. A missing, stale or
+       damaged cache reads as empty, so that its tables are rebuilt."""
+    if not path:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parseCache(data)
+    except (OSError, ValueError, struct.error):
+        return {}
+
+
+def writeCache(path, tables):
+    """Writes tables to the cache file, along with any that another process
+       has added to it meanwhile. The file is replaced in one step, so
+       readers never see it half written. Failing to write it is not an
+       error, as the tables are already in memory."""
+    if not path:
+        return
+    tables = dict(readCache(path), **tables)
+    names = sorted(tables)
+    offset = HEADER.size + ENTRY.size * len(names)
+    directory = []
+    body = []
+    for name in names:
+        typecode, data = tables[name]
+        directory.append(ENTRY.pack(name.encode(), typecode.encode(), offset,
+                                    len(data)))
+        body.append(data)
+        offset += len(data)
+    contents = b"".join(directory + body)
+    header = HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(names),
+                         zlib.crc32(contents))
+
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp, "wb") as f:
+            f.write(header + contents)
+        os.replace(temp, path)
+    except OSError:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
@@ -0,0 +1,258 @@
+import struct
+from constants import *
+import tables
+
+BLOCK = struct.Struct(">4I")
+
+
+def rotateWord(word):
+    """Rotates a 32-bit word right by one byte"""
+    return ((word >> 8) | (word << 24)) & 0xFFFFFFFF
+
+
+def buildTables(sbox, m0, m1, m2, m3):
+    """Returns four 256-entry lookup tables combining SubBytes with one
+       column of the (Inv)MixColumns matrix. Table k is table 0 rotated
+       right by k bytes, which accounts for the row's position in ShiftRows.
+       """
+    table0 = []
+    for x in range(256):
+        s = sbox[x]
+        table0.append((m0[s] << 24) | (m1[s] << 16) | (m2[s] << 8) | m3[s])
+    tables = [tuple(table0)]
+    for k in range(3):
+        tables.append(tuple(rotateWord(w) for w in tables[-1]))
+    return tuple(tables)
+
+
+MUL1 = tuple(range(256))
+
+
+def encryptTables():
+    """Returns the encryption tables, which hold (2s, s, s, 3s) for
+       s = SBOX[x], as one flat sequence"""
+    return [w for t in buildTables(SBOX, MUL2, MUL1, MUL1, MUL3) for w in t]
+
+
+def decryptTables():
+    """Returns the decryption tables, which hold (14s, 9s, 13s, 11s) for
+       s = SBOX_INV[x], as one flat sequence"""
+    return [w for t in buildTables(SBOX_INV, MUL14, MUL9, MUL13, MUL11)
+            for w in t]
+
+
+def splitTables(words):
+    """Splits a flat array of words back into four tuples of 256 entries"""
+    return tuple(tuple(words[k * 256:(k + 1) * 256]) for k in range(4))
+
+
+# SHA-256 of each cached table, checked whenever it is loaded or built
+TE_DIGEST = (
+    "493402f3e4397b2945b16273e795816c0bdf80f76f42fcaa75f3df2e215abc1b")
+TD_DIGEST = (
+    "ce11d6deaffc6d6ef6030e30e7444c933e6261f32aa737064ef0446c219ece22")
+
+# Each direction's tables are only built, or loaded from the table cache,
+# when a block is first ciphered in that direction
+tables.register("TE", "I", encryptTables, splitTables, TE_DIGEST)
+tables.register("TD", "I", decryptTables, splitTables, TD_DIGEST)
+
+
+def transposeWords(a, b, c, d):
+    """Transposes a 4x4 block of bytes held as four 32-bit words"""
+    return ((a & 0xFF000000) | ((b >> 8) & 0xFF0000) |
+            ((c >> 16) & 0xFF00) | (d >> 24),
+            ((a << 8) & 0xFF000000) | (b & 0xFF0000) |
+            ((c >> 8) & 0xFF00) | ((d >> 16) & 0xFF),
+            ((a << 16) & 0xFF000000) | ((b << 8) & 0xFF0000) |
+            (c & 0xFF00) | ((d >> 8) & 0xFF),
+            ((a << 24) & 0xFF000000) | ((b << 16) & 0xFF0000) |
+            ((c << 8) & 0xFF00) | (d & 0xFF))
+
+
+def wordSchedule(keySchedule):
+    """Converts a key schedule of 4-byte words into a list of 32-bit ints"""
+    words = []
+    for word in keySchedule:
+        value = 0
+        for byte in word:
+            if isinstance(byte, bytes):
+                byte = byte[0]
+            value = (value << 8) | byte
+        words.append(value)
+    return words
+
+
+def inverseWordSchedule(words, numRounds):
+    """Returns the key schedule for the equivalent inverse cipher: round keys
+       in reverse order, with InvMixColumns applied to every round key but
+       the first and last."""
+    Td0, Td1, Td2, Td3 = tables.get("TD")
+    inverse = list(words[numRounds*4:numRounds*4 + 4])
+    for r in range(numRounds - 1, 0, -1):
+        for w in words[r*4:r*4 + 4]:
+            inverse.append(Td0[SBOX[w >> 24]] ^
+                           Td1[SBOX[(w >> 16) & 0xFF]] ^
+                           Td2[SBOX[(w >> 8) & 0xFF]] ^
+                           Td3[SBOX[w & 0xFF]])
+    inverse += words[0:4]
+    return inverse
+
+
+def encryptBlock(s0, s1, s2, s3, rk, numRounds):
+    """Encrypts one block given as four 32-bit column words and returns the
+       resulting four column words."""
+    Te0, Te1, Te2, Te3 = tables.get("TE")
+    s0 ^= rk[0]
+    s1 ^= rk[1]
+    s2 ^= rk[2]
+    s3 ^= rk[3]
+    k = 4
+    for r in range(1, numRounds):
+        t0 = (Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^
+              Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ rk[k])
+        t1 = (Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^
+              Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ rk[k+1])
+        t2 = (Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^
+              Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ rk[k+2])
+        t3 = (Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^
+              Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ rk[k+3])
+        s0, s1, s2, s3 = t0, t1, t2, t3
+        k += 4
+
+    # Last round has no MixColumns, so use the SBOX directly
+    S = SBOX
+    return ((S[s0 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 |
+             S[(s2 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ rk[k],
+            (S[s1 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 |
+             S[(s3 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ rk[k+1],
+            (S[s2 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 |
+             S[(s0 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ rk[k+2],
+            (S[s3 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 |
+             S[(s1 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ rk[k+3])
+
+
+def decryptBlock(s0, s1, s2, s3, drk, numRounds):
+    """Decrypts one block given as four 32-bit column words, using a key
+       schedule from inverseWordSchedule(), and returns the resulting four
+       column words."""
+    Td0, Td1, Td2, Td3 = tables.get("TD")
+    s0 ^= drk[0]
+    s1 ^= drk[1]
+    s2 ^= drk[2]
+    s3 ^= drk[3]
+    k = 4
+    for r in range(1, numRounds):
+        t0 = (Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^
+              Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ drk[k])
+        t1 = (Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^
+              Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ drk[k+1])
+        t2 = (Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^
+              Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ drk[k+2])
+        t3 = (Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^
+              Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ drk[k+3])
+        s0, s1, s2, s3 = t0, t1, t2, t3
+        k += 4
+
+    # Last round has no InvMixColumns, so use the SBOX_INV directly
+    S = SBOX_INV
+    return ((S[s0 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 |
+             S[(s2 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ drk[k],
+            (S[s1 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 |
+             S[(s3 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ drk[k+1],
+            (S[s2 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 |
+             S[(s0 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ drk[k+2],
+            (S[s3 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 |
+             S[(s1 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ drk[k+3])
+
+
+def encryptBlocks(src, srcOffset, dst, dstOffset, numBlocks, rk, numRounds,
+                  transpose=False):
+    """Encrypts numBlocks blocks read from src at srcOffset and writes them
+       into the writable buffer dst at dstOffset. The state is kept in local
+       variables and unpacked from and packed into the buffers directly, so
+       no objects are created per block beyond Python ints. If transpose is
+       True, each input block is laid out row by row."""
+    Te0, Te1, Te2, Te3 = tables.get("TE")
+    S = SBOX
+    unpack = BLOCK.unpack_from
+    pack = BLOCK.pack_into
+    last = numRounds * 4
+    k0, k1, k2, k3 = rk[0], rk[1], rk[2], rk[3]
+    for i in range(numBlocks):
+        s0, s1, s2, s3 = unpack(src, srcOffset)
+        if transpose:
+            s0, s1, s2, s3 = transposeWords(s0, s1, s2, s3)
+        s0 ^= k0
+        s1 ^= k1
+        s2 ^= k2
+        s3 ^= k3
+        k = 4
+        while k < last:
+            t0 = (Te0[s0 >> 24] ^ Te1[(s1 >> 16) & 0xFF] ^
+                  Te2[(s2 >> 8) & 0xFF] ^ Te3[s3 & 0xFF] ^ rk[k])
+            t1 = (Te0[s1 >> 24] ^ Te1[(s2 >> 16) & 0xFF] ^
+                  Te2[(s3 >> 8) & 0xFF] ^ Te3[s0 & 0xFF] ^ rk[k+1])
+            t2 = (Te0[s2 >> 24] ^ Te1[(s3 >> 16) & 0xFF] ^
+                  Te2[(s0 >> 8) & 0xFF] ^ Te3[s1 & 0xFF] ^ rk[k+2])
+            s3 = (Te0[s3 >> 24] ^ Te1[(s0 >> 16) & 0xFF] ^
+                  Te2[(s1 >> 8) & 0xFF] ^ Te3[s2 & 0xFF] ^ rk[k+3])
+            s0, s1, s2 = t0, t1, t2
+            k += 4
+        pack(dst, dstOffset,
+             (S[s0 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 |
+              S[(s2 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ rk[k],
+             (S[s1 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 |
+              S[(s3 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ rk[k+1],
+             (S[s2 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 |
+              S[(s0 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ rk[k+2],
+             (S[s3 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 |
+              S[(s1 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ rk[k+3])
+        srcOffset += 16
+        dstOffset += 16
+
+
+def decryptBlocks(src, srcOffset, dst, dstOffset, numBlocks, drk, numRounds,
+                  transpose=False):
+    """Decrypts numBlocks blocks read from src at srcOffset into the writable
+       buffer dst at dstOffset, using a key schedule from
+       inverseWordSchedule(). Like encryptBlocks(), nothing is allocated per
+       block beyond Python ints. If transpose is True, each output block is
+       laid out row by row."""
+    Td0, Td1, Td2, Td3 = tables.get("TD")
+    S = SBOX_INV
+    unpack = BLOCK.unpack_from
+    pack = BLOCK.pack_into
+    last = numRounds * 4
+    k0, k1, k2, k3 = drk[0], drk[1], drk[2], drk[3]
+    for i in range(numBlocks):
+        s0, s1, s2, s3 = unpack(src, srcOffset)
+        s0 ^= k0
+        s1 ^= k1
+        s2 ^= k2
+        s3 ^= k3
+        k = 4
+        while k < last:
+            t0 = (Td0[s0 >> 24] ^ Td1[(s3 >> 16) & 0xFF] ^
+                  Td2[(s2 >> 8) & 0xFF] ^ Td3[s1 & 0xFF] ^ drk[k])
+            t1 = (Td0[s1 >> 24] ^ Td1[(s0 >> 16) & 0xFF] ^
+                  Td2[(s3 >> 8) & 0xFF] ^ Td3[s2 & 0xFF] ^ drk[k+1])
+            t2 = (Td0[s2 >> 24] ^ Td1[(s1 >> 16) & 0xFF] ^
+                  Td2[(s0 >> 8) & 0xFF] ^ Td3[s3 & 0xFF] ^ drk[k+2])
+            s3 = (Td0[s3 >> 24] ^ Td1[(s2 >> 16) & 0xFF] ^
+                  Td2[(s1 >> 8) & 0xFF] ^ Td3[s0 & 0xFF] ^ drk[k+3])
+            s0, s1, s2 = t0, t1, t2
+            k += 4
+        t0 = (S[s0 >> 24] << 24 | S[(s3 >> 16) & 0xFF] << 16 |
+              S[(s2 >> 8) & 0xFF] << 8 | S[s1 & 0xFF]) ^ drk[k]
+        t1 = (S[s1 >> 24] << 24 | S[(s0 >> 16) & 0xFF] << 16 |
+              S[(s3 >> 8) & 0xFF] << 8 | S[s2 & 0xFF]) ^ drk[k+1]
+        t2 = (S[s2 >> 24] << 24 | S[(s1 >> 16) & 0xFF] << 16 |
+              S[(s0 >> 8) & 0xFF] << 8 | S[s3 & 0xFF]) ^ drk[k+2]
+        t3 = (S[s3 >> 24] << 24 | S[(s2 >> 16) & 0xFF] << 16 |
+              S[(s1 >> 8) & 0xFF] << 8 | S[s0 & 0xFF]) ^ drk[k+3]
+        if transpose:
+            t0, t1, t2, t3 = transposeWords(t0, t1, t2, t3)
+        pack(dst, dstOffset, t0, t1, t2, t3)
+        srcOffset += 16
+        dstOffset += 16
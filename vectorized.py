@@ -0,0 +1,122 @@
+from constants import *
+import tables
+
+# NumPy is only imported once the engine is asked for, as importing it
+# takes longer than ciphering a small file
+np = None
+numpyChecked = False
+
+# Number of blocks processed per batch; bounds the size of the temporaries
+CHUNK_BLOCKS = 1 << 16
+
+# Blocks are stored column by column, so byte r + 4c is row r, column c.
+# ShiftRows moves row r left by r columns: new[r, c] = old[r, c + r]
+SHIFT_ROWS = [r + 4 * ((c + r) % 4) for c in range(4) for r in range(4)]
+INV_SHIFT_ROWS = [r + 4 * ((c - r) % 4) for c in range(4) for r in range(4)]
+# Converts between row by row and column by column block layouts
+TRANSPOSE = [4 * r + c for c in range(4) for r in range(4)]
+
+
+def available():
+    """Returns True if NumPy is installed and the engine can be used. NumPy
+       is imported by the first call."""
+    global np, numpyChecked
+    if not numpyChecked:
+        numpyChecked = True
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+    return np is not None
+
+
+def encryptTables():
+    """Returns SBOX, MUL2 and MUL3 as arrays"""
+    return tuple(np.array(t, dtype=np.uint8) for t in (SBOX, MUL2, MUL3))
+
+
+def decryptTables():
+    """Returns SBOX_INV, MUL9, MUL11, MUL13 and MUL14 as arrays"""
+    return tuple(np.array(t, dtype=np.uint8)
+                 for t in (SBOX_INV, MUL9, MUL11, MUL13, MUL14))
+
+
+tables.register("numpyEncrypt", None, encryptTables)
+tables.register("numpyDecrypt", None, decryptTables)
+
+
+def roundKeyArray(keySchedule, numRounds):
+    """Converts a key schedule of 4-byte words into a (numRounds + 1, 16)
+       array holding one round key per row."""
+    flat = []
+    for word in keySchedule[:(numRounds+1)*4]:
+        for byte in word:
+            flat.append(byte[0] if isinstance(byte, bytes) else byte)
+    return np.array(flat, dtype=np.uint8).reshape(numRounds + 1, 16)
+
+
+def mixColumns(state, out):
+    """Applies MixColumns to every column of every block in the state"""
+    _, mul2, mul3 = tables.get("numpyEncrypt")
+    cols = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = (cols[:, :, i] for i in range(4))
+    res = out.reshape(-1, 4, 4)
+    res[:, :, 0] = mul2[a0] ^ mul3[a1] ^ a2 ^ a3
+    res[:, :, 1] = a0 ^ mul2[a1] ^ mul3[a2] ^ a3
+    res[:, :, 2] = a0 ^ a1 ^ mul2[a2] ^ mul3[a3]
+    res[:, :, 3] = mul3[a0] ^ a1 ^ a2 ^ mul2[a3]
+    return out
+
+
+def invMixColumns(state, out):
+    """Applies InvMixColumns to every column of every block in the state"""
+    _, mul9, mul11, mul13, mul14 = tables.get("numpyDecrypt")
+    cols = state.reshape(-1, 4, 4)
+    a0, a1, a2, a3 = (cols[:, :, i] for i in range(4))
+    res = out.reshape(-1, 4, 4)
+    res[:, :, 0] = mul14[a0] ^ mul11[a1] ^ mul13[a2] ^ mul9[a3]
+    res[:, :, 1] = mul9[a0] ^ mul14[a1] ^ mul11[a2] ^ mul13[a3]
+    res[:, :, 2] = mul13[a0] ^ mul9[a1] ^ mul14[a2] ^ mul11[a3]
+    res[:, :, 3] = mul11[a0] ^ mul13[a1] ^ mul9[a2] ^ mul14[a3]
+    return out
+
+
+def encryptArray(state, rk, numRounds):
+    """Encrypts an (N, 16) array of column by column blocks"""
+    sbox = tables.get("numpyEncrypt")[0]
+    state = state ^ rk[0]
+    mixed = np.empty_like(state)
+    for r in range(1, numRounds):
+        state = sbox[state[:, SHIFT_ROWS]]
+        state = mixColumns(state, mixed)
+        state ^= rk[r]
+    return sbox[state[:, SHIFT_ROWS]] ^ rk[numRounds]
+
+
+def decryptArray(state, rk, numRounds):
+    """Decrypts an (N, 16) array of column by column blocks"""
+    invSbox = tables.get("numpyDecrypt")[0]
+    state = state ^ rk[numRounds]
+    mixed = np.empty_like(state)
+    for r in range(numRounds - 1, 0, -1):
+        state = invSbox[state[:, INV_SHIFT_ROWS]] ^ rk[r]
+        state = invMixColumns(state, mixed)
+    return invSbox[state[:, INV_SHIFT_ROWS]] ^ rk[0]
+
+
+def cipherBlocks(data, rk, numRounds, decrypt):
+    """Encrypts or decrypts whole 16-byte blocks of data with a round key
+       array from roundKeyArray(), a batch of blocks at a time. Uses the same
+       block layout as the T-table engine: the plaintext side of each block
+       is row by row."""
+    blocks = np.frombuffer(data, dtype=np.uint8).reshape(-1, 16)
+    out = np.empty_like(blocks)
+    for start in range(0, len(blocks), CHUNK_BLOCKS):
+        batch = blocks[start:start + CHUNK_BLOCKS]
+        if decrypt:
+            out[start:start + len(batch)] = \
+                decryptArray(batch, rk, numRounds)[:, TRANSPOSE]
+        else:
+            out[start:start + len(batch)] = \
+                encryptArray(batch[:, TRANSPOSE], rk, numRounds)
+    return out.tobytes()